@@ -0,0 +1,267 @@
+"""
+Persistence benchmark on synthetic datasets, no Telegram access needed.
+
+Usage: python benchmark.py [--sizes 10000,100000,1000000] [--ops 1000] [--storage sqlite] [--output results.json]
+
+Every dataset is generated in a fresh storage engine (a temporary SQLite file by default), then each `UserManager`
+operation is timed and reported as JSON (ops/sec, p50/p99 latency, peak traced memory, max RSS),
+so results of different versions can be compared.
+
+Allocation tracing slows Python code several times, so the datasets are run twice:
+the timings and the RSS come from a first pass with tracing off, the traced memory from a second pass.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import AsyncIterator, Awaitable, Callable
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any
+
+from persistence import Storage, User, UserManager
+from storage import STORAGE_ENGINES, create_storage
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SEED_BATCH: int = 10_000
+SEED_DAYS: int = 90
+SEED_INVITED_RATIO: float = 0.3
+
+
+class Result:
+    def __init__(self,
+                 rows: int,
+                 operation: str,
+                 latencies: list[float],
+                 items: int,
+                 peak_memory: int | None,
+                 max_rss: int | None):
+        self.rows = rows
+        self.operation = operation
+        self.latencies = sorted(latencies)
+        self.items = items
+        self.peak_memory = peak_memory
+        self.max_rss = max_rss
+
+    def _percentile(self, p: float) -> float:
+        index = min(len(self.latencies) - 1, round(p * (len(self.latencies) - 1)))
+        return self.latencies[index]
+
+    def to_dict(self) -> dict[str, Any]:
+        total = sum(self.latencies)
+        return {
+            "rows": self.rows,
+            "operation": self.operation,
+            "calls": len(self.latencies),
+            "items": self.items,
+            "total_s": round(total, 6),
+            "ops_per_sec": round(self.items / total, 2) if total > 0 else None,
+            "p50_ms": round(self._percentile(0.50) * 1000, 4),
+            "p99_ms": round(self._percentile(0.99) * 1000, 4),
+            "peak_memory_bytes": self.peak_memory,
+            "max_rss_bytes": self.max_rss,
+        }
+
+
+def max_rss() -> int | None:
+    """
+    Peak resident set size of the process so far, in bytes. Unlike the traced memory it includes
+    the allocations made outside Python, e.g. the SQLite page cache and the mmap pages read.
+    """
+
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+async def measure(rows: int,
+                  operation: str,
+                  calls: list[Callable[[], Awaitable[int]]]) -> Result:
+    """
+    Awaits every call in order, each call returns how many items it processed.
+    The peak traced memory is recorded only if `tracemalloc` is tracing.
+    """
+
+    latencies: list[float] = []
+    items = 0
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+    for call in calls:
+        start = time.perf_counter()
+        items += await call()
+        latencies.append(time.perf_counter() - start)
+    peak_memory: int | None = None
+    if tracing:
+        _, peak = tracemalloc.get_traced_memory()
+        peak_memory = max(0, peak - baseline)
+    return Result(rows, operation, latencies, items, peak_memory, max_rss())
+
+
+async def seed(storage: Storage, rows: int, rng: random.Random) -> None:
+    """Bulk inserts `rows` synthetic users, ids 1..rows, created over the last `SEED_DAYS` days"""
+
+    now = datetime.now()
+    span = SEED_DAYS * 24 * 3600
+    for start in range(1, rows + 1, SEED_BATCH):
+        batch = []
+        for telegram_id in range(start, min(start + SEED_BATCH, rows + 1)):
+            created_at = now - timedelta(seconds=rng.randrange(span))
+            invited_at = created_at + timedelta(hours=1) if rng.random() < SEED_INVITED_RATIO else None
+            batch.append(User(telegram_id, f"user{telegram_id}", created_at, invited_at))
+        await storage.insert_users(batch)
+
+
+async def _count(iterator: AsyncIterator[Any]) -> int:
+    count = 0
+    async for _ in iterator:
+        count += 1
+    return count
+
+
+async def run_dataset(rows: int, args: argparse.Namespace) -> list[Result]:
+    rng = random.Random(args.seed)
+    results: list[Result] = []
+    with tempfile.TemporaryDirectory(prefix="marketbot-bench-") as tmp_dir:
+        storage = create_storage(args.storage, str(Path(tmp_dir) / "bench.db"), args.pool_size)
+        await storage.open()
+        try:
+            users = UserManager(storage, cache_size=args.cache_size)
+
+            results.append(await measure(rows, "seed", [lambda: _seeded(storage, rows, rng)]))
+
+            # half hits, half misses
+            ids = [rng.randint(1, rows) if i % 2 == 0 else rows + 1 + i for i in range(args.ops)]
+            results.append(await measure(rows, "find", [
+                lambda telegram_id=telegram_id: _found(users, telegram_id)
+                for telegram_id in ids
+            ]))
+
+            results.append(await measure(rows, "create", [
+                lambda telegram_id=telegram_id: _created(users, telegram_id)
+                for telegram_id in range(rows + 1, rows + 1 + args.ops)
+            ]))
+
+            for include_invited in (True, False):
+                suffix = "all" if include_invited else "not_invited"
+                results.append(await measure(rows, f"read_all[{suffix}]", [
+                    lambda: _count(users.read_all(include_invited=include_invited, page_size=args.page_size))
+                    for _ in range(args.repeat)
+                ]))
+                results.append(await measure(rows, f"read_all_ids[{suffix}]", [
+                    lambda: _count(users.read_all_ids(include_invited=include_invited, page_size=args.page_size))
+                    for _ in range(args.repeat)
+                ]))
+
+            results.append(await measure(rows, "update_to_invited", [
+                lambda telegram_id=telegram_id: _invited(users, telegram_id)
+                for telegram_id in (rng.randint(1, rows) for _ in range(args.ops))
+            ]))
+
+            results.append(await measure(rows, "delete_all", [lambda: _deleted_all(users, rows + args.ops)]))
+        finally:
+            await storage.close()
+    return results
+
+
+async def _seeded(storage: Storage, rows: int, rng: random.Random) -> int:
+    await seed(storage, rows, rng)
+    return rows
+
+
+async def _found(users: UserManager, telegram_id: int) -> int:
+    await users.find(telegram_id)
+    return 1
+
+
+async def _created(users: UserManager, telegram_id: int) -> int:
+    await users.create(telegram_id, f"user{telegram_id}")
+    return 1
+
+
+async def _invited(users: UserManager, telegram_id: int) -> int:
+    await users.update_to_invited(telegram_id)
+    return 1
+
+
+async def _deleted_all(users: UserManager, rows: int) -> int:
+    await users.delete_all()
+    return rows
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    results: list[Result] = []
+    for rows in args.sizes:
+        results.extend(await run_dataset(rows, args))
+
+    # same datasets and calls (same seed), traced: only the memory figures are kept
+    peaks: dict[tuple[int, str], int | None] = {}
+    tracemalloc.start()
+    try:
+        for rows in args.sizes:
+            for traced in await run_dataset(rows, args):
+                peaks[(traced.rows, traced.operation)] = traced.peak_memory
+    finally:
+        tracemalloc.stop()
+    for result in results:
+        result.peak_memory = peaks[(result.rows, result.operation)]
+
+    return {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "storage": args.storage,
+            "ops": args.ops,
+            "repeat": args.repeat,
+            "page_size": args.page_size,
+            "pool_size": args.pool_size,
+            "cache_size": args.cache_size,
+            "seed": args.seed,
+        },
+        "results": [result.to_dict() for result in results],
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        type=lambda s: [int(size) for size in s.split(",")],
+                        help="comma separated dataset sizes (rows)")
+    parser.add_argument("--ops", type=int, default=1000, help="calls per point operation")
+    parser.add_argument("--repeat", type=int, default=3, help="full scans per read_all mode")
+    parser.add_argument("--page-size", type=int, default=UserManager.PAGE_SIZE)
+    parser.add_argument("--storage", choices=STORAGE_ENGINES, default="sqlite")
+    parser.add_argument("--pool-size", type=int, default=4, help="sqlite storage only")
+    parser.add_argument("--cache-size", type=int, default=100_000, help="find LRU cache size, 0 disables it")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=Path, default=None, help="write JSON here instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        args.output.write_text(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""In-process index of the scout client dialogs"""
+
+import asyncio
+import time
+from collections.abc import Callable
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from telethon import TelegramClient
+    from telethon.tl.custom.dialog import Dialog
+
+
+class DialogIndex:
+    """
+    Name → Dialog and id → Dialog lookups over the client dialogs.
+    Dialogs are fetched once and fetched again only when older than `ttl` seconds,
+    on `invalidate`, on a forced refresh or when a lookup misses.
+    """
+
+    def __init__(self, client: Callable[[], "TelegramClient"], ttl: float = 300.0):
+        """`client` returns the client to read, it is called on every fetch so the client can be created lazily"""
+
+        self.client = client
+        self.ttl = ttl
+        self._dialogs: list[Dialog] = []
+        self._by_name: dict[str, Dialog] = {}
+        self._by_id: dict[int, Dialog] = {}
+        self._loaded_at: float | None = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def invalidate(self) -> None:
+        """Drops the cached dialogs, the next lookup fetches them again"""
+        self._loaded_at = None
+
+    async def _load(self) -> None:
+        dialogs: list[Dialog] = [dialog async for dialog in self.client().iter_dialogs()]
+        by_name: dict[str, Dialog] = {}
+        by_id: dict[int, Dialog] = {}
+        for dialog in dialogs:
+            # the first dialog wins on duplicated names, as in the client order
+            by_name.setdefault(dialog.name, dialog)
+            by_id[dialog.id] = dialog
+        self._dialogs, self._by_name, self._by_id = dialogs, by_name, by_id
+        self._loaded_at = time.monotonic()
+
+    async def _ensure_fresh(self, force: bool = False) -> bool:
+        """Returns `True` if the dialogs have been fetched during the call, by this task or another one"""
+
+        if not force and not self.is_stale:
+            return False
+        loaded_at = self._loaded_at
+        async with self._lock:
+            # another task refreshed the index while this one was waiting for the lock
+            if self._loaded_at != loaded_at and not self.is_stale:
+                return True
+            await self._load()
+        return True
+
+    async def all(self, *, force_refresh: bool = False) -> "list[Dialog]":
+        await self._ensure_fresh(force_refresh)
+        return self._dialogs
+
+    def _get(self, name_or_id: str) -> "Dialog | None":
+        if (dialog := self._by_name.get(name_or_id)) is not None:
+            return dialog
+        try:
+            return self._by_id.get(int(name_or_id))
+        except ValueError:
+            return None
+
+    async def find(self, name_or_id: str) -> "Dialog | None":
+        """
+        The dialog named `name_or_id`, or else with that id.
+        On a miss the dialogs are fetched again once, the chat may have been joined since the last fetch.
+        """
+
+        refreshed = await self._ensure_fresh()
+        if (dialog := self._get(name_or_id)) is None and not refreshed:
+            await self._ensure_fresh(force=True)
+            dialog = self._get(name_or_id)
+        return dialog
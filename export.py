@@ -0,0 +1,100 @@
+"""Streaming users export, built in a spooled buffer instead of a file in the working directory"""
+
+import csv
+import gzip
+import io
+from collections.abc import Callable
+from datetime import datetime
+from enum import StrEnum
+from tempfile import SpooledTemporaryFile
+from typing import IO, Any
+
+from persistence import User, UserManager
+
+# exports bigger than this spill from memory to an anonymous temporary file
+SPOOL_MAX_SIZE: int = 8 * 1024 * 1024
+BATCH_SIZE: int = 1000
+
+
+class ExportFormat(StrEnum):
+    CSV = "csv"
+    TXT = "txt"
+
+
+class Export:
+    def __init__(self, file: IO[bytes], filename: str, rows: int):
+        self.file = file
+        self.filename = filename
+        self.rows = rows
+
+
+CSV_HEADER: tuple[str, ...] = ("telegram_id", "username", "created_at", "invited_at")
+
+
+def csv_fields(user: User) -> tuple:
+    """CSV columns of `user`, shared by the exports and the retention archive"""
+
+    invited_at = user.invited_at.isoformat() if user.invited_at is not None else ""
+    return user.telegram_id, user.username, user.created_at.isoformat(), invited_at
+
+
+def _write_header(text: io.StringIO, writer: Any, fmt: ExportFormat, until_to: datetime) -> None:
+    match fmt:
+        case ExportFormat.CSV:
+            writer.writerow(CSV_HEADER)
+        case ExportFormat.TXT:
+            text.write(f"Statistics until {until_to}:\n\nid | username | created_at | invited_at\n\n")
+
+
+def _write_row(text: io.StringIO, writer: Any, fmt: ExportFormat, user: User) -> None:
+    match fmt:
+        case ExportFormat.CSV:
+            writer.writerow(csv_fields(user))
+        case ExportFormat.TXT:
+            text.write(f"{user.telegram_id} | {user.username} | {user.created_at} | {user.invited_at}\n")
+
+
+async def export_users(users: UserManager,
+                       until_to: datetime,
+                       *,
+                       fmt: ExportFormat = ExportFormat.CSV,
+                       compress: bool = True,
+                       batch_size: int = BATCH_SIZE,
+                       on_progress: Callable[[int], None] | None = None) -> Export:
+    """
+    Streams all the users created until `until_to`, invited ones included, from the database page by page,
+    encoding (and compressing) one batch of rows per write.
+    The returned file is rewound, ready to be sent, and deleted as soon as it is closed.
+    """
+
+    spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    sink: IO[bytes] = gzip.GzipFile(fileobj=spool, mode="wb") if compress else spool
+    text = io.StringIO(newline="")
+    writer = csv.writer(text)
+    rows = 0
+
+    def flush() -> None:
+        sink.write(text.getvalue().encode())
+        text.seek(0)
+        text.truncate()
+
+    try:
+        _write_header(text, writer, fmt, until_to)
+        async for user in users.read_all(until_to=until_to, include_invited=True, page_size=batch_size):
+            _write_row(text, writer, fmt, user)
+            rows += 1
+            if rows % batch_size == 0:
+                flush()
+                if on_progress is not None:
+                    on_progress(rows)
+        flush()
+        if compress:
+            # writes the gzip trailer, `spool` stays open
+            sink.close()
+    except BaseException:
+        spool.close()
+        raise
+
+    spool.seek(0)
+    suffix = ".gz" if compress else ""
+    return Export(spool, f"stat_{until_to:%Y%m%d_%H%M%S}.{fmt}{suffix}", rows)
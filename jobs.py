@@ -0,0 +1,132 @@
+"""Background runner for long-running admin operations"""
+
+import asyncio
+import itertools
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from enum import StrEnum, auto
+
+from telegram import Message
+from telegram.error import TelegramError
+
+from metrics import Metrics
+
+
+class JobState(StrEnum):
+    QUEUED = auto()
+    RUNNING = auto()
+
+
+class Job:
+    def __init__(self, job_id: int, name: str, chat_id: int):
+        self.id = job_id
+        self.name = name
+        self.chat_id = chat_id
+        self.state: JobState = JobState.QUEUED
+        self.progress: str = ""
+        self.submitted_at: float = time.monotonic()
+        self.task: asyncio.Task | None = None
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds since the job has been submitted"""
+        return time.monotonic() - self.submitted_at
+
+    def report(self, progress: str) -> None:
+        """Called by the job itself, shown in the next status message update"""
+        self.progress = progress
+
+    def describe(self) -> str:
+        progress = f", {self.progress}" if self.progress else ""
+        return f"#{self.id} {self.name} ({self.state}, {self.elapsed:.0f}s{progress})"
+
+
+# a job receives its own `Job` to report progress and returns the final text for the admin
+JobFunc = Callable[[Job], Awaitable[str]]
+
+
+class JobRunner:
+    """
+    asyncio task registry with bounded concurrency.
+    Each job owns a status message, edited every `progress_interval` seconds
+    with the job progress and finally with its outcome.
+    """
+
+    def __init__(self, max_concurrency: int = 2, progress_interval: float = 5.0, metrics: Metrics | None = None):
+        if max_concurrency < 1:
+            raise ValueError(f"Max concurrency must be at least 1, got {max_concurrency}")
+        self.progress_interval = progress_interval
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._jobs: dict[int, Job] = {}
+        self._ids = itertools.count(1)
+
+    def jobs(self) -> list[Job]:
+        return list(self._jobs.values())
+
+    async def submit(self, name: str, message: Message, func: JobFunc) -> Job:
+        """Replies to `message` with the job status message and schedules `func`"""
+
+        job = Job(next(self._ids), name, message.chat_id)
+        status = await message.reply_text(f"Job #{job.id} {name} queued. "
+                                          f"Use /jobs to follow it, /cancel {job.id} to stop it.")
+        self._jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, func, status), name=f"job-{job.id}-{name}")
+        return job
+
+    def cancel(self, job_id: int) -> bool:
+        """Returns `False` if there is no such job"""
+
+        if (job := self._jobs.get(job_id)) is None or job.task is None:
+            return False
+        job.task.cancel()
+        return True
+
+    async def shutdown(self) -> None:
+        tasks = [job.task for job in self._jobs.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, job: Job, func: JobFunc, status: Message) -> None:
+        outcome: str
+        try:
+            async with self._semaphore:
+                job.state = JobState.RUNNING
+                reporter = asyncio.create_task(self._report_progress(job, status))
+                try:
+                    with self.metrics.timed("job", job.name):
+                        result = await func(job)
+                finally:
+                    reporter.cancel()
+            outcome = f"Job #{job.id} {job.name} completed in {job.elapsed:.0f}s. {result}"
+        except asyncio.CancelledError:
+            outcome = f"Job #{job.id} {job.name} cancelled after {job.elapsed:.0f}s."
+        except Exception as err:
+            logging.exception("Job #%d %s failed", job.id, job.name,
+                              extra={"command": job.name, "job_id": job.id, "chat_id": job.chat_id})
+            outcome = f"Job #{job.id} {job.name} failed after {job.elapsed:.0f}s: {err}"
+        finally:
+            self._jobs.pop(job.id, None)
+        logging.info("Job #%d %s ended", job.id, job.name,
+                     extra={"command": job.name, "job_id": job.id, "chat_id": job.chat_id,
+                            "duration_ms": round(job.elapsed * 1000, 3)})
+        await self._edit(status, outcome)
+
+    async def _report_progress(self, job: Job, status: Message) -> None:
+        last_text = ""
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            text = f"Job {job.describe()}"
+            # telegram refuses edits that do not change the text
+            if text != last_text:
+                await self._edit(status, text)
+                last_text = text
+
+    @staticmethod
+    async def _edit(status: Message, text: str) -> None:
+        try:
+            await status.edit_text(text)
+        except TelegramError as err:
+            logging.error("Cannot update job status message: %s", err)
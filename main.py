@@ -1,15 +1,44 @@
+import asyncio
+import json
 import logging
+import os
 import sys
-from service import Service, Config
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
 
-logging.basicConfig(level=logging.INFO)
+from logs import setup_logging
 
+if TYPE_CHECKING:
+    from service import Config, Service
 
-def load_env() -> Config:
+
+class StartupProfile:
+    """Wall time of each startup phase, printed by `--profile-startup`"""
+
+    def __init__(self):
+        self.phases_ms: dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases_ms[name] = round((time.perf_counter() - start) * 1000, 3)
+
+    def report(self) -> str:
+        return json.dumps({"phases_ms": self.phases_ms, "total_ms": round(sum(self.phases_ms.values()), 3)},
+                          indent=2)
+
+
+def load_env() -> "Config":
     """Loads the secret info from the environment and parse them"""
 
     from dotenv import load_dotenv
-    import os
+    from service import Config
+    from storage import STORAGE_ENGINES
 
     load_dotenv()
 
@@ -18,6 +47,17 @@ def load_env() -> Config:
     api_id = os.getenv('API_ID')
     api_hash = os.getenv('API_HASH')
     phone = os.getenv('PHONE')
+    db_url = os.getenv('DB_URL', 'market_bot.db')
+    db_pool_size = os.getenv('DB_POOL_SIZE', '4')
+    dialog_cache_ttl = os.getenv('DIALOG_CACHE_TTL', '300')
+    concurrent_updates = os.getenv('CONCURRENT_UPDATES', '16')
+    max_jobs = os.getenv('MAX_JOBS', '2')
+    metrics_port = os.getenv('METRICS_PORT')
+    find_cache_size = os.getenv('FIND_CACHE_SIZE', '100000')
+    retention_days = os.getenv('RETENTION_DAYS')
+    archive_path = os.getenv('ARCHIVE_PATH', 'market_bot_archive.csv.gz')
+    retention_interval = os.getenv('RETENTION_INTERVAL', '3600')
+    storage = os.getenv('STORAGE', 'sqlite')
 
     critical_message: str = ""
     if admins_str is None:
@@ -42,16 +82,75 @@ def load_env() -> Config:
         if phone[0] != '+':
             raise ValueError(f"{phone} has not the right format")
         _ = int(phone[1:])
+        db_pool_size = int(db_pool_size)
+        if db_pool_size < 1:
+            raise ValueError(f"DB_POOL_SIZE must be at least 1, got {db_pool_size}")
+        dialog_cache_ttl = float(dialog_cache_ttl)
+        concurrent_updates = int(concurrent_updates)
+        if concurrent_updates < 1:
+            raise ValueError(f"CONCURRENT_UPDATES must be at least 1, got {concurrent_updates}")
+        max_jobs = int(max_jobs)
+        if max_jobs < 1:
+            raise ValueError(f"MAX_JOBS must be at least 1, got {max_jobs}")
+        if metrics_port is not None:
+            metrics_port = int(metrics_port)
+        find_cache_size = int(find_cache_size)
+        if retention_days is not None:
+            retention_days = int(retention_days)
+        retention_interval = float(retention_interval)
+        if storage not in STORAGE_ENGINES:
+            raise ValueError(f"STORAGE must be one of {', '.join(STORAGE_ENGINES)}, got {storage}")
     except ValueError as verr:
         raise Exception(verr)
     logging.info("Environment load.")
 
-    return Config(admins=admins, api_id=api_id, api_hash=api_hash, bot_token=str(bot_token), phone=phone)
+    return Config(admins=admins, api_id=api_id, api_hash=api_hash, bot_token=str(bot_token), phone=phone,
+                  db_url=db_url, db_pool_size=db_pool_size, dialog_cache_ttl=dialog_cache_ttl,
+                  concurrent_updates=concurrent_updates, max_jobs=max_jobs,
+                  metrics_port=metrics_port, find_cache_size=find_cache_size, retention_days=retention_days,
+                  archive_path=archive_path, retention_interval=retention_interval, storage=storage)
+
+
+async def _profile_storage(service: "Service", profile: StartupProfile) -> None:
+    with profile.phase("open storage"):
+        await service.open_storage()
+    await service.storage.close()
 
 
-# if __name__ == '__main__':
 def main():
-    Service(load_env()).run()
+    """`--profile-startup` runs the boot steps without connecting to telegram, prints their timings and exits"""
+
+    profile = StartupProfile()
+    with profile.phase("import dotenv"):
+        from dotenv import load_dotenv
+    load_dotenv()
+    setup_logging(os.getenv('LOG_LEVEL', 'INFO'))
+
+    # the biggest dependencies first, so each one is timed on its own
+    with profile.phase("import aiosqlite"):
+        import aiosqlite  # noqa: F401
+    with profile.phase("import telegram"):
+        import telegram.ext  # noqa: F401
+    with profile.phase("import service"):
+        from service import Service
+    with profile.phase("load env"):
+        config = load_env()
+    with profile.phase("init service"):
+        service = Service(config)
+    with profile.phase("build app"):
+        service.build_app()
+
+    if "--profile-startup" in sys.argv[1:]:
+        asyncio.run(_profile_storage(service, profile))
+        # not part of the boot, reported to show what lazy loading saves
+        with profile.phase("import telethon (deferred)"):
+            import telethon  # noqa: F401
+        print(profile.report())
+        return
+
+    logging.info("Boot steps done in %.1fms.", sum(profile.phases_ms.values()))
+    service.run()
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""In-process counters and latency histograms, for the /metrics command and a Prometheus endpoint"""
+
+import asyncio
+import logging
+import math
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+
+# seconds, upper bounds of the latency histogram buckets
+BUCKETS: tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                              1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts: list[int] = [0] * len(buckets)
+        self.count: int = 0
+        self.sum: float = 0.0
+
+    def observe(self, seconds: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        """Approximated by the upper bound of the bucket holding the `q` quantile"""
+
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, bound in enumerate(self.buckets):
+            cumulative += self.counts[i]
+            if cumulative >= rank:
+                # the last bucket is unbounded, report the biggest finite bound
+                return bound if not math.isinf(bound) else self.buckets[-2]
+        return self.buckets[-2]
+
+
+class Metrics:
+    """
+    Calls, errors and latency of each timed operation, grouped by kind
+    (e.g. "handler" for the bot commands, "query" for the `UserManager` queries).
+    """
+
+    def __init__(self):
+        self._calls: dict[tuple[str, str], int] = {}
+        self._errors: dict[tuple[str, str], int] = {}
+        self._latency: dict[tuple[str, str], Histogram] = {}
+        self._gauges: dict[str, Callable[[], float]] = {}
+
+    def observe(self, kind: str, name: str, seconds: float, failed: bool = False) -> None:
+        key = (kind, name)
+        self._calls[key] = self._calls.get(key, 0) + 1
+        if failed:
+            self._errors[key] = self._errors.get(key, 0) + 1
+        if (histogram := self._latency.get(key)) is None:
+            histogram = self._latency[key] = Histogram()
+        histogram.observe(seconds)
+
+    def gauge(self, name: str, read: Callable[[], float]) -> None:
+        """Registers a value read at render time, e.g. a cache size"""
+        self._gauges[name] = read
+
+    @contextmanager
+    def timed(self, kind: str, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.observe(kind, name, time.perf_counter() - start, failed)
+
+    def render_summary(self) -> str:
+        """Human readable report, one line per timed operation"""
+
+        lines: list[str] = []
+        for (kind, name), histogram in sorted(self._latency.items()):
+            errors = self._errors.get((kind, name), 0)
+            lines.append(f"{kind} {name}: {histogram.count} calls, {errors} errors, "
+                         f"avg {histogram.sum / histogram.count * 1000:.1f}ms, "
+                         f"p50 ≤{histogram.quantile(0.5) * 1000:g}ms, p99 ≤{histogram.quantile(0.99) * 1000:g}ms")
+        for name, read in sorted(self._gauges.items()):
+            lines.append(f"{name}: {read():g}")
+        return "\n".join(lines) if lines else "No metrics recorded yet."
+
+    def render_prometheus(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+
+        lines: list[str] = []
+        for kind in sorted({kind for kind, _ in self._latency}):
+            metric = f"marketbot_{kind}"
+            keys = sorted(key for key in self._latency if key[0] == kind)
+
+            lines.append(f"# TYPE {metric}_calls_total counter")
+            lines.extend(f'{metric}_calls_total{{{kind}="{name}"}} {self._calls[(kind, name)]}' for _, name in keys)
+            lines.append(f"# TYPE {metric}_errors_total counter")
+            lines.extend(f'{metric}_errors_total{{{kind}="{name}"}} {self._errors.get((kind, name), 0)}'
+                         for _, name in keys)
+
+            lines.append(f"# TYPE {metric}_latency_seconds histogram")
+            for key in keys:
+                name = key[1]
+                histogram = self._latency[key]
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if math.isinf(bound) else f"{bound:g}"
+                    lines.append(f'{metric}_latency_seconds_bucket{{{kind}="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{metric}_latency_seconds_sum{{{kind}="{name}"}} {histogram.sum}')
+                lines.append(f'{metric}_latency_seconds_count{{{kind}="{name}"}} {histogram.count}')
+
+        for name, read in sorted(self._gauges.items()):
+            lines.append(f"# TYPE marketbot_{name} gauge")
+            lines.append(f"marketbot_{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int) -> asyncio.Server:
+        """Starts a minimal HTTP server answering `GET /metrics` with `render_prometheus`"""
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            try:
+                request_line = await reader.readline()
+                # drains the headers, the request has no body
+                while await reader.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+                parts = request_line.decode("latin-1").split()
+                if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                    status, body = "200 OK", self.render_prometheus().encode()
+                else:
+                    status, body = "404 Not Found", b"Not found\n"
+                writer.write(f"HTTP/1.1 {status}\r\n"
+                             f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                             f"Content-Length: {len(body)}\r\n"
+                             f"Connection: close\r\n\r\n".encode() + body)
+                await writer.drain()
+            except (ConnectionError, UnicodeDecodeError) as err:
+                logging.error("Metrics request failed: %s", err)
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
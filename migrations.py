@@ -0,0 +1,136 @@
+"""Versioned schema migrations, tracked through `PRAGMA user_version`"""
+
+import logging
+
+from storage import ConnectionPool
+
+# MIGRATIONS[n] brings the schema from version n to version n + 1.
+# Append only: never edit or reorder a migration that has been released.
+MIGRATIONS: list[tuple[str, ...]] = [
+    # 1. initial schema (`create_db` up to now, so existing databases are left untouched)
+    ("""create table if not exists user (
+telegram_id integer,
+username text not null,
+created_at timestamp default current_timestamp,
+invited_at timestamp,
+primary key(telegram_id))""",),
+
+    # 2. indexes for `UserManager.read_all*` predicates.
+    # telegram_id is the rowid, so both indexes cover the ids only queries.
+    ("create index if not exists user_created_at_idx on user(created_at)",
+     "create index if not exists user_not_invited_idx on user(telegram_id, created_at) where invited_at is null"),
+
+    # 3. timestamps as integer epoch seconds, so date ranges are numeric, indexable comparisons.
+    # Columns are declared `epoch` to be read back as `datetime` (see storage converters).
+    # Old values are sqlite `current_timestamp` strings, which are UTC.
+    ("""create table user_v3 (
+telegram_id integer,
+username text not null,
+created_at epoch not null default (cast(strftime('%s', 'now') as integer)),
+invited_at epoch,
+primary key(telegram_id))""",
+     """insert into user_v3(telegram_id, username, created_at, invited_at)
+select telegram_id,
+       username,
+       coalesce(cast(strftime('%s', created_at) as integer), cast(strftime('%s', 'now') as integer)),
+       cast(strftime('%s', invited_at) as integer)
+from user""",
+     "drop table user",
+     "alter table user_v3 rename to user",
+     "create index user_created_at_idx on user(created_at)",
+     "create index user_not_invited_idx on user(telegram_id, created_at) where invited_at is null"),
+
+    # 4. statistics summary tables, kept up to date by triggers on user.
+    # `day` is the UTC epoch day (epoch seconds / 86400).
+    ("""create table user_daily_stat (
+day integer primary key,
+created integer not null default 0,
+invited integer not null default 0)""",
+     """create table user_total_stat (
+id integer primary key check (id = 1),
+created integer not null,
+invited integer not null)""",
+     "insert into user_total_stat(id, created, invited) select 1, count(*), count(invited_at) from user",
+     """insert into user_daily_stat(day, created, invited)
+select day, sum(created), sum(invited) from (
+    select created_at / 86400 as day, 1 as created, 0 as invited from user
+    union all
+    select invited_at / 86400, 0, 1 from user where invited_at is not null)
+group by day""",
+     """create trigger user_stat_insert after insert on user
+begin
+    insert into user_daily_stat(day, created) values (new.created_at / 86400, 1)
+        on conflict(day) do update set created = created + 1;
+    insert into user_daily_stat(day, invited) select new.invited_at / 86400, 1 where new.invited_at is not null
+        on conflict(day) do update set invited = invited + 1;
+    update user_total_stat set created = created + 1, invited = invited + (new.invited_at is not null);
+end""",
+     """create trigger user_stat_update after update of invited_at on user
+begin
+    update user_daily_stat set invited = invited - 1
+        where old.invited_at is not null and day = old.invited_at / 86400;
+    insert into user_daily_stat(day, invited) select new.invited_at / 86400, 1 where new.invited_at is not null
+        on conflict(day) do update set invited = invited + 1;
+    update user_total_stat
+        set invited = invited - (old.invited_at is not null) + (new.invited_at is not null);
+end""",
+     """create trigger user_stat_delete after delete on user
+begin
+    update user_daily_stat set created = created - 1 where day = old.created_at / 86400;
+    update user_daily_stat set invited = invited - 1
+        where old.invited_at is not null and day = old.invited_at / 86400;
+    update user_total_stat set created = created - 1, invited = invited - (old.invited_at is not null);
+end"""),
+
+    # 5. invite events ledger, for the sliding window invite limit (see persistence.InviteLedger)
+    ("""create table invite_event (
+id integer primary key,
+invited_at epoch not null,
+telegram_id integer not null)""",
+     "create index invite_event_invited_at_idx on invite_event(invited_at)"),
+]
+
+
+async def enable_incremental_vacuum(pool: ConnectionPool) -> None:
+    """
+    Switches the database to `auto_vacuum = incremental`, so free pages can be released
+    with `UserManager.compact`. Existing databases need a full `vacuum` once,
+    which cannot run inside a transaction and so is not a migration.
+    """
+
+    async with pool.acquire() as db:
+        async with db.execute("pragma auto_vacuum") as cursor:
+            mode: int = (await cursor.fetchone())[0]
+        if mode != 2:  # 2 = incremental
+            logging.info("Enabling incremental auto vacuum, the database is rebuilt once.")
+            await db.execute("pragma auto_vacuum = incremental")
+            await db.execute("vacuum")
+
+
+async def migrate(pool: ConnectionPool) -> int:
+    """
+    Applies every migration newer than the database `user_version`,
+    each one in its own transaction. Returns the resulting schema version.
+    """
+
+    async with pool.acquire() as db:
+        async with db.execute("pragma user_version") as cursor:
+            current: int = (await cursor.fetchone())[0]
+        if current > len(MIGRATIONS):
+            raise RuntimeError(f"Database schema version {current} is newer than this release "
+                               f"(latest known {len(MIGRATIONS)})")
+
+        for version, statements in enumerate(MIGRATIONS[current:], start=current + 1):
+            await db.execute("begin")
+            try:
+                for statement in statements:
+                    await db.execute(statement)
+                # pragma arguments cannot be bound
+                await db.execute(f"pragma user_version = {version}")
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+            logging.info("Database schema migrated to version %d.", version)
+
+    return len(MIGRATIONS)
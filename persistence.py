@@ -1,9 +1,12 @@
+import asyncio
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import AbstractContextManager
 from dataclasses import dataclass
-from datetime import datetime
-from functools import wraps
+from datetime import date, datetime, timedelta
 from typing import Any
-from aiosqlite import connect, Connection, Row
-from collections.abc import Generator
+from metrics import Metrics
+from collections.abc import AsyncIterator, Awaitable, Callable
 
 
 @dataclass
@@ -11,102 +14,352 @@ class User:
     telegram_id: int
     username: str
     created_at: datetime
-    invited_at: datetime
+    invited_at: datetime | None
 
 
-def connect_db(db_url):
+@dataclass
+class DailyStat:
+    day: date  # UTC
+    created: int
+    invited: int
+
+
+@dataclass
+class StatSummary:
+    created: int
+    invited: int
+    daily: list[DailyStat]
+
+
+class LRUCache:
+    """Bounded mapping that evicts the least recently used key, with hit/miss counters"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits: int = 0
+        self.misses: int = 0
+        self._data: OrderedDict[int, bool] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: int) -> bool | None:
+        if (value := self._data.get(key)) is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: int, value: bool) -> None:
+        if self.max_size <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def discard(self, key: int) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class Storage(ABC):
     """
-    solid — Dependency Inversion
-    Top level modules should not depend
-    on lower level modules,
-    so on I am taking db path as parameter
+    Storage engine behind `UserManager` and `InviteLedger`, implemented in the `storage` module.
+    Engines only store and query: caching, pagination and metrics are left to the managers.
     """
 
-    def decorator(func):
-        wraps(func)
+    @abstractmethod
+    async def open(self) -> None:
+        """Prepares the engine (connections, schema), called once per process before any query"""
+
+    @abstractmethod
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    def describe(self) -> str:
+        """Short description for the logs"""
+
+    @abstractmethod
+    async def insert_user(self, telegram_id: int, username: str) -> bool:
+        """Stores a new user created now, `False` if `telegram_id` was already stored"""
+
+    @abstractmethod
+    async def insert_users(self, users: list[User]) -> None:
+        """Bulk inserts complete users, e.g. synthetic datasets"""
 
-        async def wrapper(*args, **kwargs):
-            async with connect(db_url) as db:
-                return await func(db, *args, **kwargs)
-        return wrapper
+    @abstractmethod
+    async def has_user(self, telegram_id: int) -> bool:
+        pass
 
-    return decorator
+    @abstractmethod
+    async def users_page(self, after_id: int, until_to: datetime, include_invited: bool, size: int) -> list[User]:
+        """At most `size` users with id greater than `after_id` created until `until_to`, ordered by id"""
 
+    @abstractmethod
+    async def user_ids_page(self, after_id: int, until_to: datetime, include_invited: bool, size: int) -> list[int]:
+        """Like `users_page`, but only the telegram ids"""
 
-@connect_db(db_url="market_bot.db")
-async def create_db(db: Connection) -> None:
-    await db.execute("""create table if not exists user (
-telegram_id integer,
-username text not null,
-created_at timestamp default current_timestamp,
-invited_at timestamp,
-primary key(telegram_id))""")
+    @abstractmethod
+    async def summary(self, days: int) -> StatSummary:
+        pass
+
+    @abstractmethod
+    async def users_created_before(self, before: datetime, limit: int) -> list[User]:
+        """The oldest users created before `before`, at most `limit`"""
+
+    @abstractmethod
+    async def set_invited(self, telegram_id: int, invited_at: datetime) -> None:
+        pass
+
+    @abstractmethod
+    async def delete_user(self, telegram_id: int) -> None:
+        pass
+
+    @abstractmethod
+    async def delete_users(self, telegram_ids: list[int]) -> None:
+        """Deletes all the `telegram_ids` users at once"""
+
+    @abstractmethod
+    async def delete_all_users(self) -> None:
+        pass
+
+    @abstractmethod
+    async def compact(self, pages: int) -> int:
+        """Releases up to `pages` unused pages, returns how many are left"""
+
+    @abstractmethod
+    async def invite_times_after(self, start: datetime) -> list[datetime]:
+        """Times of the invite events after `start`, oldest first"""
+
+    @abstractmethod
+    async def insert_invite(self, telegram_id: int, invited_at: datetime, prune_before: datetime) -> None:
+        """Records an invite event and drops the events older than `prune_before`"""
 
 
 class UserManager:
-    @staticmethod
-    @connect_db(db_url="market_bot.db")
-    async def create(db: Connection,
-                     telegram_id: int,
-                     username: str) -> int:
-        if await UserManager.find(telegram_id) > 0:
+    PAGE_SIZE: int = 500
+    MIN_TELEGRAM_ID: int = -(1 << 63)
+
+    def __init__(self, storage: Storage, metrics: Metrics | None = None, cache_size: int = 100_000):
+        self.storage = storage
+        self.metrics = metrics if metrics is not None else Metrics()
+        # telegram_id -> stored or not, negative results included
+        self.cache = LRUCache(cache_size)
+        # bumped by every write, a lookup started before a write must not fill the cache
+        self._writes: int = 0
+        self.metrics.gauge("find_cache_hits", lambda: self.cache.hits)
+        self.metrics.gauge("find_cache_misses", lambda: self.cache.misses)
+        self.metrics.gauge("find_cache_size", lambda: len(self.cache))
+
+    def _timed(self, name: str) -> AbstractContextManager[None]:
+        """Times a storage call in the manager metrics"""
+        return self.metrics.timed("query", name)
+
+    def _written(self, telegram_id: int | None = None) -> None:
+        """Invalidates the cached lookup of `telegram_id`, or all of them if `None`"""
+
+        self._writes += 1
+        if telegram_id is None:
+            self.cache.clear()
+        else:
+            self.cache.discard(telegram_id)
+
+    async def create(self, telegram_id: int, username: str) -> int:
+        """Returns `telegram_id` if the user has been inserted, 0 if it was already stored"""
+
+        if self.cache.get(telegram_id):
             return 0
-        await db.execute("insert into user(telegram_id, username) values (?, ?)", (telegram_id, username))
-        await db.commit()
-        return telegram_id
-
-    @staticmethod
-    @connect_db(db_url="market_bot.db")
-    async def find(db: Connection,
-                   telegram_id: int) -> int:
+        with self._timed("insert"):
+            inserted = await self.storage.insert_user(telegram_id, username)
+        self._written(telegram_id)
+        self.cache.put(telegram_id, True)
+        return telegram_id if inserted else 0
+
+    async def find(self, telegram_id: int) -> int:
         """Returns the firs entry that matches the specific telegram id if found"""
-        db.row_factory = Row
-        row: Row
-        async with db.execute("select * from user where telegram_id = ?", (telegram_id,)) as cursor:
-            row = await cursor.fetchone()
-        return 0 if row is None else row['telegram_id']
-
-    @staticmethod
-    def _read_all_query_builder(include_invited: bool, only_ids: bool) -> str:
-        """Util. Builder for read_all* users query"""
-
-        where_inv_only = "and invited_at is null" if not include_invited else ""
-        what_select = "telegram_id" if only_ids else "*"
-        query = f'select {what_select} from user where user.created_at <= ? {where_inv_only} limit ?'
-        return query
-
-    @staticmethod
-    @connect_db(db_url="market_bot.db")
-    async def read_all(db: Connection,
+
+        if (stored := self.cache.get(telegram_id)) is not None:
+            return telegram_id if stored else 0
+        writes = self._writes
+        with self._timed("find"):
+            found = await self.storage.has_user(telegram_id)
+        if writes == self._writes:
+            self.cache.put(telegram_id, found)
+        return telegram_id if found else 0
+
+    async def _paginate(self,
+                        name: str,
+                        fetch: Callable[[int, int], Awaitable[list]],
+                        key: Callable[[Any], int],
+                        limit: int | None,
+                        page_size: int) -> AsyncIterator:
+        """
+        Yields the items of `fetch(after_id, size)` one page at a time, keyset paginated on `key`.
+        Nothing is held by the storage between pages, so consumers can
+        write to it while iterating.
+        """
+
+        if page_size < 1:
+            raise ValueError(f"Page size must be at least 1, got {page_size}")
+
+        last_id = UserManager.MIN_TELEGRAM_ID
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(page_size, remaining)
+            with self._timed(name):
+                items = await fetch(last_id, size)
+            for item in items:
+                yield item
+            if len(items) < size:
+                return
+            if remaining is not None:
+                remaining -= len(items)
+            last_id = key(items[-1])
+
+    async def read_all(self,
                        *,
-                       until_to: datetime = datetime.now(),
+                       until_to: datetime | None = None,
                        include_invited: bool = False,
-                       limit: int = 1000
-                       ) -> Generator[User, Any, None]:
-        """Returns a generator of all users full info to use them efficiently"""
-
-        db.row_factory = Row
-        query = UserManager._read_all_query_builder(include_invited, only_ids=False)
-        sqlite3_dt_fmt = until_to.strftime("%Y/%m/%d %H:%M:%S")
-        return (User(row['telegram_id'], row['username'], row['created_at'], row['invited_at'])
-                for row in await db.execute_fetchall(query, [sqlite3_dt_fmt, limit]))
-
-    @staticmethod
-    @connect_db(db_url="market_bot.db")
-    async def update_to_invited(db: Connection,
-                                telegram_id: int) -> None:
-        await db.execute("update user set invited_at = current_timestamp where telegram_id = ?",
-                         (telegram_id,))
-        await db.commit()
-
-    @staticmethod
-    @connect_db(db_url="market_bot.db")
-    async def delete(db: Connection, telegram_id: int) -> None:
-        await db.execute("delete from user where telegram_id = ?", (telegram_id,))
-        await db.commit()
-
-    @staticmethod
-    @connect_db(db_url="market_bot.db")
-    async def delete_all(db: Connection) -> None:
-        await db.execute("delete from user")
-        await db.commit()
+                       limit: int | None = None,
+                       page_size: int = PAGE_SIZE
+                       ) -> AsyncIterator[User]:
+        """
+        Async iterator over all users full info created until `until_to` (now by default).
+        Only `page_size` users are held in memory at once, whatever the table size.
+        """
+
+        until_to = until_to or datetime.now()
+
+        def fetch(after_id: int, size: int) -> Awaitable[list[User]]:
+            return self.storage.users_page(after_id, until_to, include_invited, size)
+
+        async for user in self._paginate("read_all", fetch, lambda user: user.telegram_id, limit, page_size):
+            yield user
+
+    async def read_all_ids(self,
+                           *,
+                           until_to: datetime | None = None,
+                           include_invited: bool = False,
+                           limit: int | None = None,
+                           page_size: int = PAGE_SIZE
+                           ) -> AsyncIterator[int]:
+        """Like `read_all`, but yields only the telegram ids"""
+
+        until_to = until_to or datetime.now()
+
+        def fetch(after_id: int, size: int) -> Awaitable[list[int]]:
+            return self.storage.user_ids_page(after_id, until_to, include_invited, size)
+
+        async for telegram_id in self._paginate("read_all_ids", fetch, lambda telegram_id: telegram_id,
+                                                limit, page_size):
+            yield telegram_id
+
+    async def summary(self, days: int = 30) -> StatSummary:
+        """
+        Totals and per day counts of created and invited users, for the last `days` active days.
+        Kept up to date by the storage on every write, so no user is scanned.
+        """
+
+        with self._timed("summary"):
+            return await self.storage.summary(days)
+
+    async def read_created_before(self, before: datetime, limit: int) -> list[User]:
+        """The oldest users created before `before`, at most `limit`"""
+
+        with self._timed("read_created_before"):
+            return await self.storage.users_created_before(before, limit)
+
+    async def update_to_invited(self, telegram_id: int) -> None:
+        with self._timed("update_to_invited"):
+            await self.storage.set_invited(telegram_id, datetime.now())
+        self._written(telegram_id)
+
+    async def delete(self, telegram_id: int) -> None:
+        with self._timed("delete"):
+            await self.storage.delete_user(telegram_id)
+        self._written(telegram_id)
+        self.cache.put(telegram_id, False)
+
+    async def delete_many(self, telegram_ids: list[int]) -> None:
+        """Deletes all the `telegram_ids` users at once"""
+
+        with self._timed("delete_many"):
+            await self.storage.delete_users(telegram_ids)
+        self._written()
+
+    async def delete_all(self) -> None:
+        with self._timed("delete_all"):
+            await self.storage.delete_all_users()
+        self._written()
+
+    async def compact(self, pages: int) -> int:
+        """Releases up to `pages` unused storage pages, returns the free pages left"""
+
+        with self._timed("compact"):
+            return await self.storage.compact(pages)
+
+
+class InviteLedger:
+    """
+    Durable sliding window limit of `limit` invites every `window`.
+    Each invite is a stored event, so the limit survives restarts. The event times
+    still inside the window (never more than `limit`) are cached in memory,
+    loaded once from the storage, so checking the limit is free.
+    """
+
+    # events older than this are pruned from the ledger
+    HISTORY: timedelta = timedelta(days=30)
+
+    def __init__(self,
+                 storage: Storage,
+                 metrics: Metrics | None = None,
+                 limit: int = 200,
+                 window: timedelta = timedelta(days=1)):
+        self.storage = storage
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.limit = limit
+        self.window = window
+        self._recent: deque[datetime] | None = None
+        self._load_lock = asyncio.Lock()
+
+    async def _window(self) -> deque[datetime]:
+        """The cached invites inside the window ending now, oldest first"""
+
+        if self._recent is None:
+            async with self._load_lock:
+                # a concurrent first call may have loaded it (and `record` appended to it) meanwhile
+                if self._recent is None:
+                    with self.metrics.timed("query", "load"):
+                        recent = deque(await self.storage.invite_times_after(datetime.now() - self.window))
+                    self._recent = recent
+        start = datetime.now() - self.window
+        while self._recent and self._recent[0] <= start:
+            self._recent.popleft()
+        return self._recent
+
+    async def used(self) -> int:
+        return len(await self._window())
+
+    async def remaining(self) -> int:
+        return max(0, self.limit - await self.used())
+
+    async def next_slot(self) -> datetime:
+        """When the next invite will be allowed, now if the limit is not reached"""
+
+        recent = await self._window()
+        if len(recent) < self.limit:
+            return datetime.now()
+        return recent[len(recent) - self.limit] + self.window
+
+    async def record(self, telegram_id: int) -> None:
+        # loads the window first, otherwise the new event would be both loaded and appended
+        recent = await self._window()
+        invited_at = datetime.now()
+        with self.metrics.timed("query", "insert_invite"):
+            await self.storage.insert_invite(telegram_id, invited_at, invited_at - self.HISTORY)
+        recent.append(invited_at)
@@ -0,0 +1,82 @@
+"""Archival of old users and incremental vacuum of the working database"""
+
+import asyncio
+import csv
+import gzip
+import io
+import logging
+import os
+from datetime import datetime, timedelta
+
+from export import CSV_HEADER, csv_fields
+from persistence import User, UserManager
+
+
+class RetentionPolicy:
+    def __init__(self,
+                 *,
+                 max_age_days: int | None = None,
+                 archive_path: str = "market_bot_archive.csv.gz",
+                 batch_size: int = 1000,
+                 vacuum_pages: int = 2000,
+                 interval: float = 3600.0):
+        """`max_age_days` `None` keeps every user, only the periodic vacuum runs"""
+
+        if max_age_days is not None and max_age_days < 1:
+            raise ValueError(f"Retention must be at least 1 day, got {max_age_days}")
+        self.max_age_days = max_age_days
+        self.archive_path = archive_path
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.interval = interval
+
+
+class Archiver:
+    """
+    Moves the users older than the policy allows to an append-only archive:
+    a gzip file made of one member per batch (`zcat` and `gzip.open` read it as a single CSV).
+    Each batch is written to the archive before being deleted from the database,
+    so a crash in between may only duplicate rows in the archive, never lose them.
+    """
+
+    def __init__(self, users: UserManager, policy: RetentionPolicy):
+        self.users = users
+        self.policy = policy
+
+    def _append(self, batch: list[User]) -> None:
+        text = io.StringIO(newline="")
+        writer = csv.writer(text)
+        if not os.path.exists(self.policy.archive_path) or os.path.getsize(self.policy.archive_path) == 0:
+            writer.writerow(CSV_HEADER)
+        writer.writerows(csv_fields(user) for user in batch)
+        with open(self.policy.archive_path, "ab") as archive:
+            archive.write(gzip.compress(text.getvalue().encode()))
+            archive.flush()
+            os.fsync(archive.fileno())
+
+    async def archive(self) -> int:
+        """Archives the users created before the retention period, returns how many"""
+
+        if self.policy.max_age_days is None:
+            return 0
+        before = datetime.now() - timedelta(days=self.policy.max_age_days)
+        archived = 0
+        while batch := await self.users.read_created_before(before, self.policy.batch_size):
+            await asyncio.to_thread(self._append, batch)
+            await self.users.delete_many([user.telegram_id for user in batch])
+            archived += len(batch)
+        return archived
+
+    async def run_once(self) -> None:
+        archived = await self.archive()
+        free_pages = await self.users.compact(self.policy.vacuum_pages)
+        logging.info("Retention: %d users archived to %s, %d free pages left.",
+                     archived, self.policy.archive_path, free_pages)
+
+    async def run_forever(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logging.exception("Retention run failed")
+            await asyncio.sleep(self.policy.interval)
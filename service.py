@@ -1,32 +1,59 @@
 from telegram import Update
-from telegram.ext import filters, ApplicationBuilder, CommandHandler, MessageHandler
+from telegram.ext import filters, Application, ApplicationBuilder, CommandHandler, MessageHandler
 from telegram.ext import ContextTypes
 
-import telethon.types
-from telethon import TelegramClient
-from telethon.tl.types import InputChannel, InputUser
-from telethon.tl.custom.dialog import Dialog
-from telethon.tl.functions.channels import InviteToChannelRequest
-from telethon.errors.rpcerrorlist import PeerFloodError, UserPrivacyRestrictedError
-
+from collections.abc import Iterator
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from enum import StrEnum, auto
+import asyncio
 import logging
 import os
+import time
+import weakref
+from typing import TYPE_CHECKING
 
 import persistence
-from persistence import create_db, UserManager
+from dialogs import DialogIndex
+from export import ExportFormat, export_users
+from jobs import Job, JobRunner
+from metrics import Metrics
+from persistence import InviteLedger, UserManager
+from retention import Archiver, RetentionPolicy
+from storage import create_storage
 
-logging.basicConfig(level=logging.ERROR)
+if TYPE_CHECKING:
+    # telethon takes a noticeable share of the startup, it is imported on first use (see `scout_client`)
+    from telethon import TelegramClient
+    from telethon.tl.custom.dialog import Dialog
 
 
 class Config:
-    def __init__(self, *, admins: list[int], api_id: int, api_hash: str, bot_token: str, phone: str):
+    def __init__(self, *, admins: list[int], api_id: int, api_hash: str, bot_token: str, phone: str,
+                 db_url: str = "market_bot.db", db_pool_size: int = 4, dialog_cache_ttl: float = 300.0,
+                 concurrent_updates: int = 16, max_jobs: int = 2, metrics_port: int | None = None,
+                 find_cache_size: int = 100_000, retention_days: int | None = None,
+                 archive_path: str = "market_bot_archive.csv.gz", retention_interval: float = 3600.0,
+                 storage: str = "sqlite"):
         self.admins = admins
         self.api_id = api_id
         self.api_hash = api_hash
         self.bot_token = bot_token
         self.phone = phone
+        self.db_url = db_url
+        self.db_pool_size = db_pool_size
+        self.dialog_cache_ttl = dialog_cache_ttl
+        self.concurrent_updates = concurrent_updates
+        self.max_jobs = max_jobs
+        # local Prometheus endpoint, disabled if `None`
+        self.metrics_port = metrics_port
+        self.find_cache_size = find_cache_size
+        # users older than `retention_days` are moved to `archive_path`, `None` keeps them all
+        self.retention_days = retention_days
+        self.archive_path = archive_path
+        self.retention_interval = retention_interval
+        # storage engine, see `storage.STORAGE_ENGINES`: "memory" keeps nothing across restarts
+        self.storage = storage
 
 
 class CommandType(StrEnum):
@@ -45,82 +72,221 @@ class Service:
 
     def __init__(self, config: Config):
         self.config = config
-        self.last_cmd: CommandType = CommandType.NO_OP
-        self.invited_users_24h: int = 0
-        self.last_invite: datetime = datetime.now()
-
-        self.scout_client: TelegramClient = TelegramClient('real_user', config.api_id, config.api_hash)
+        # conversation state of each admin chat, absent means NO_OP
+        self.last_cmds: dict[int, CommandType] = {}
+        # keeps the text messages of the same chat in order, other chats run concurrently
+        # weak: a lock lives only while a message of its chat holds or waits for it,
+        # so chats of any user do not pile up here
+        self._chat_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+        # serializes the invite flow, see CommandType.INVITE
+        self._invite_lock = asyncio.Lock()
+
+        self.metrics = Metrics()
+        self.metrics_server: asyncio.Server | None = None
+        self.storage = create_storage(config.storage, config.db_url, config.db_pool_size)
+        self.users = UserManager(self.storage, self.metrics, config.find_cache_size)
+        # telegram flags accounts inviting more than 200 users a day
+        self.invites = InviteLedger(self.storage, self.metrics, limit=200, window=timedelta(days=1))
+        self.jobs = JobRunner(config.max_jobs, metrics=self.metrics)
+        self.metrics.gauge("jobs_running", lambda: len(self.jobs.jobs()))
+        self.archiver = Archiver(self.users, RetentionPolicy(max_age_days=config.retention_days,
+                                                             archive_path=config.archive_path,
+                                                             interval=config.retention_interval))
+        self._retention_task: asyncio.Task | None = None
+
+        self._scout_client: "TelegramClient | None" = None
         # DEBUG MODE: .start(phone=lambda: config.phone))
-        self.bot_client: TelegramClient | None = None
-
-        self.app = ApplicationBuilder().token(config.bot_token).build()
-        self.app.add_handler(CommandHandler("clean_cache", self._clean_cache))
-        self.app.add_handler(CommandHandler("clean_db", self._clean_db))
-        self.app.add_handler(CommandHandler("disconnect", self._disconnect))
-        self.app.add_handler(CommandHandler("start", self._start))
-        self.app.add_handler(CommandHandler("import", self._import_users))
-        self.app.add_handler(CommandHandler("invite", self._invite))
-        self.app.add_handler(CommandHandler("listchats", self._list_chats))
-        self.app.add_handler(CommandHandler("new_post", self._new_post))
-        self.app.add_handler(CommandHandler("signin", self._signin))
-        self.app.add_handler(CommandHandler("sendcode", self._send_code))
-        self.app.add_handler(CommandHandler("signout", self._sign_out))
-        self.app.add_handler(CommandHandler("stat", self._stat))
-        self.app.add_handler(CommandHandler("token", self._token))
+        self.bot_client: "TelegramClient | None" = None
+        self.dialogs = DialogIndex(lambda: self.scout_client, config.dialog_cache_ttl)
+        self._warm_up_task: asyncio.Task | None = None
+
+        self.app: Application | None = None
+
+    @property
+    def scout_client(self) -> "TelegramClient":
+        """The real user client, created on first use"""
+
+        if self._scout_client is None:
+            from telethon import TelegramClient
+            self._scout_client = TelegramClient('real_user', self.config.api_id, self.config.api_hash)
+        return self._scout_client
+
+    def build_app(self) -> Application:
+        self.app = (ApplicationBuilder()
+                    .token(self.config.bot_token)
+                    .concurrent_updates(self.config.concurrent_updates)
+                    .post_init(self._post_init)
+                    .post_stop(self._post_stop)
+                    .post_shutdown(self._post_shutdown)
+                    .build())
+        self._add_command("cancel", self._cancel, admin_only=True)
+        self._add_command("clean_cache", self._clean_cache)
+        self._add_command("clean_db", self._clean_db)
+        self._add_command("disconnect", self._disconnect)
+        self._add_command("start", self._start)
+        self._add_command("import", self._import_users)
+        self._add_command("invite", self._invite)
+        self._add_command("jobs", self._list_jobs, admin_only=True)
+        self._add_command("listchats", self._list_chats)
+        self._add_command("metrics", self._metrics, admin_only=True)
+        self._add_command("new_post", self._new_post)
+        self._add_command("signin", self._signin)
+        self._add_command("sendcode", self._send_code)
+        self._add_command("signout", self._sign_out)
+        self._add_command("stat", self._stat)
+        self._add_command("token", self._token)
         self.app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), self._text))
+        return self.app
+
+    def _add_command(self, command: str, callback, admin_only: bool = False) -> None:
+        """Registers a command handler, instrumented by `_instrument`. `admin_only` ignores other users"""
+
+        async def instrumented(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            with self._instrument(command, update):
+                await callback(update, context)
+
+        # a custom filter replaces the default one, which also ignores edited messages
+        command_filter = filters.UpdateType.MESSAGES
+        if admin_only:
+            command_filter = command_filter & filters.User(self.config.admins)
+        self.app.add_handler(CommandHandler(command, instrumented, filters=command_filter))
+
+    @contextmanager
+    def _instrument(self, command: str, update: Update) -> Iterator[None]:
+        """Times the handling of `update` in the service metrics and logs it"""
+
+        start = time.perf_counter()
+        failed = True
+        try:
+            with self.metrics.timed("handler", command):
+                yield
+            failed = False
+        finally:
+            logging.info("%s handled", command,
+                         extra={"command": command,
+                                "chat_id": update.effective_chat.id if update.effective_chat else None,
+                                "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                                "failed": failed})
+
+    def _chat_lock(self, chat_id: int) -> asyncio.Lock:
+        if (lock := self._chat_locks.get(chat_id)) is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        return lock
+
+    def _last_cmd(self, update: Update) -> CommandType:
+        return self.last_cmds.get(update.effective_chat.id, CommandType.NO_OP)
+
+    def _set_last_cmd(self, update: Update, cmd: CommandType) -> None:
+        """
+        Commands waiting for an answer set their state before sending the prompt:
+        with concurrent updates the answer may be handled before `reply_text` returns.
+        """
+
+        if cmd == CommandType.NO_OP:
+            self.last_cmds.pop(update.effective_chat.id, None)
+        else:
+            self.last_cmds[update.effective_chat.id] = cmd
 
     def run(self):
-        self.app.run_polling()
+        (self.app or self.build_app()).run_polling()
+
+    async def open_storage(self) -> None:
+        """Opens the storage engine (for SQLite: connections, migrations), once per process"""
+
+        await self.storage.open()
+        logging.info("Storage opened: %s.", self.storage.describe())
+
+    async def _post_init(self, _: Application) -> None:
+        """Boots the storage before the bot starts polling, the rest is started in background"""
+
+        await self.open_storage()
+        if self.config.metrics_port is not None:
+            self.metrics_server = await self.metrics.serve("127.0.0.1", self.config.metrics_port)
+            logging.info("Metrics served on http://127.0.0.1:%d/metrics", self.config.metrics_port)
+        self._retention_task = asyncio.create_task(self.archiver.run_forever(), name="retention")
+        self._warm_up_task = asyncio.create_task(self._warm_up_client(), name="scout-client-warm-up")
+
+    async def _warm_up_client(self) -> None:
+        """Creates and connects the scout client off the startup path, so the first command finds it ready"""
+
+        if (res := await self._check_conn()) is not None:
+            logging.error("%s", res)
+        else:
+            logging.info("Scout client connected.")
+
+    async def _post_stop(self, _: Application) -> None:
+        """Cancels the jobs while the bot can still edit their status messages, it is closed before `post_shutdown`"""
+        await self.jobs.shutdown()
+
+    async def _post_shutdown(self, _: Application) -> None:
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+            await asyncio.gather(self._warm_up_task, return_exceptions=True)
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        if self._retention_task is not None:
+            self._retention_task.cancel()
+            await asyncio.gather(self._retention_task, return_exceptions=True)
+        await self.storage.close()
+        logging.info("Storage closed.")
+
+    async def _cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """`/cancel <job id>` stops a background job"""
 
-    async def _clean_cache(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         try:
-            with os.scandir("./") as scan_iter:
-                import fnmatch
-                for file in scan_iter:
-                    if file.is_file() and fnmatch.fnmatch(file.name, "stat_*.txt"):
-                        os.remove("./" + file.name)
-            await update.message.reply_text("Stats files deleted")
-        except OSError as err:
-            await update.message.reply_text(f"{err}")
-        self.last_cmd = CommandType.NO_OP
+            job_id = int(context.args[0])
+        except (IndexError, TypeError, ValueError):
+            await update.message.reply_text("Usage: /cancel <job id>. Use /jobs to list them.")
+            return
+        if self.jobs.cancel(job_id):
+            await update.message.reply_text(f"Cancelling job #{job_id}...")
+        else:
+            await update.message.reply_text(f"Job #{job_id} not found.")
+
+    async def _clean_cache(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        self.dialogs.invalidate()
+        await self.jobs.submit("clean_cache", update.message, self._remove_stat_files)
+        self._set_last_cmd(update, CommandType.NO_OP)
 
     async def _clean_db(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        self._set_last_cmd(update, CommandType.CLEAN_DB)
         await update.message.reply_text("Are you sure you want cleanup the database? (yes/no)")
-        self.last_cmd = CommandType.CLEAN_DB
 
     async def _disconnect(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         if (res := await self._check_client()) is not None:
             await update.message.reply_text(res)
-            self.last_cmd = CommandType.NO_OP
+            self._set_last_cmd(update, CommandType.NO_OP)
         else:
             await self.scout_client.disconnect()
             await update.message.reply_text("Client disconnected.")
-            self.last_cmd = CommandType.NO_OP
+            self._set_last_cmd(update, CommandType.NO_OP)
 
     async def _import_users(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         await self._check_conn()
+        self._set_last_cmd(update, CommandType.IMPORT)
         await update.message.reply_text('From which public source group you want import? ')
-        self.last_cmd = CommandType.IMPORT
 
     async def _invite(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         await self._check_conn()
+        self._set_last_cmd(update, CommandType.INVITE)
         await update.message.reply_text('Specify limit number of users, destination group and '
                                         'if to force already invited users. Format: (e.g: 200,hotelForAll,yes)')
-        self.last_cmd = CommandType.INVITE
 
-    async def _list_chats(self, update: Update, _: ContextTypes.DEFAULT_TYPE):
-        """Lists client chats formatted"""
+    async def _list_chats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Lists client chats formatted. `/listchats refresh` fetches them again from telegram."""
 
         if (res := await self._check_client()) is not None:
             await update.message.reply_text(res)
-            self.last_cmd = CommandType.NO_OP
+            self._set_last_cmd(update, CommandType.NO_OP)
             return
 
+        force_refresh = "refresh" in (context.args or [])
         groups: list[str] = []
         channels: list[str] = []
         user_chats: list[str] = []
         dialog: Dialog
-        async for dialog in self.scout_client.iter_dialogs():
+        for dialog in await self.dialogs.all(force_refresh=force_refresh):
             if dialog.is_group:
                 groups.append(f"{dialog.name}: {dialog.id})")
             elif dialog.is_channel:
@@ -136,12 +302,21 @@ class Service:
                     f'Channels:\n{channels_fmt}\n\n'
                     f'Private chats:\n{user_chats_fmt}')
         await update.message.reply_text(response)
-        self.last_cmd = CommandType.NO_OP
+        self._set_last_cmd(update, CommandType.NO_OP)
+
+    async def _list_jobs(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        jobs = self.jobs.jobs()
+        response = "\n".join(job.describe() for job in jobs) if jobs else "No background jobs running."
+        await update.message.reply_text(response)
+
+    async def _metrics(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        """Calls, errors and latency of handlers, jobs and queries since startup"""
+        await update.message.reply_text(self.metrics.render_summary())
 
     async def _new_post(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         if self.bot_client.is_user_authorized() and self.bot_client.is_connected():
+            self._set_last_cmd(update, CommandType.POST)
             await update.message.reply_text("Write your post here.")
-            self.last_cmd = CommandType.POST
         else:
             await update.message.reply_text("Please use /token to login your userbot.")
 
@@ -151,19 +326,19 @@ class Service:
         else:
             await self.scout_client.send_code_request(self.config.phone)
             await update.message.reply_text(f"Auth code sent on {self.config.phone}. Use /signin to login.")
-        self.last_cmd = CommandType.NO_OP
+        self._set_last_cmd(update, CommandType.NO_OP)
 
     async def _signin(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        self._set_last_cmd(update, CommandType.SIGNIN)
         await update.message.reply_text(f'Please paste the auth code received on {self.config.phone}')
-        self.last_cmd = CommandType.SIGNIN
 
     async def _sign_out(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         if (res := await self._check_client()) is not None:
             await update.message.reply_text(res)
-            self.last_cmd = CommandType.NO_OP
+            self._set_last_cmd(update, CommandType.NO_OP)
         else:
+            self._set_last_cmd(update, CommandType.SIGN_OUT)
             await update.message.reply_text("Are you sure you want log out the real user? (yes/no) ")
-            self.last_cmd = CommandType.SIGN_OUT
 
     async def _start(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         """Bot entry point callback. Allowed only to admins."""
@@ -173,8 +348,6 @@ class Service:
                 f"Sorry {update.effective_user.first_name} you're not enabled for this service.")
             return
 
-        await create_db()
-
         message: str = f'Hello {update.effective_user.first_name}!'
         if not await self.scout_client.is_user_authorized():
             _ = await self.scout_client.send_code_request(self.config.phone)
@@ -182,15 +355,39 @@ class Service:
                                             f'Call /signin command to login.')
         else:
             await self._check_conn()
+            self._set_last_cmd(update, CommandType.TOKEN_INIT)
             await update.message.reply_text(f'{message} Please write the bot user token for add users.')
-            self.last_cmd = CommandType.TOKEN_INIT
 
-    async def _stat(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
-        await update.message.reply_text('From which date you want statistics? (DD-MM-YYYY). \'today\' for all.')
-        self.last_cmd = CommandType.STAT
+    async def _stat(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """`/stat summary` answers from the summary tables, `/stat` exports the users file"""
+
+        if context.args and context.args[0].lower() == "summary":
+            await update.message.reply_text(self._format_summary(await self.users.summary(),
+                                                                 await self.invites.remaining(),
+                                                                 await self.invites.next_slot()))
+            self._set_last_cmd(update, CommandType.NO_OP)
+            return
+
+        self._set_last_cmd(update, CommandType.STAT)
+        await update.message.reply_text('From which date you want statistics? (DD-MM-YYYY). \'today\' for all.\n'
+                                        'Optionally add the file format: csv, csv.gz (default), txt, txt.gz '
+                                        '(e.g: today,csv).\n'
+                                        'Use /stat summary for daily counts instead of the full users file.')
 
     async def _text(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Text handler based on the last command"""
+        """Text handler based on the last command of the chat"""
+
+        async with self._chat_lock(update.effective_chat.id):
+            with self._instrument(f"text_{self._last_cmd(update)}", update):
+                await self._handle_text(update, context)
+
+    async def _handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        import telethon.types
+        from telethon import TelegramClient
+        from telethon.tl.types import InputChannel, InputUser
+        from telethon.tl.custom.dialog import Dialog
+        from telethon.tl.functions.channels import InviteToChannelRequest
+        from telethon.errors.rpcerrorlist import PeerFloodError, UserPrivacyRestrictedError
 
         response: str = ""
         message_text = update.message.text
@@ -198,17 +395,18 @@ class Service:
             await update.message.reply_text("Message text empty.")
             return
 
-        match self.last_cmd:
+        last_cmd = self._last_cmd(update)
+        match last_cmd:
             case CommandType.CLEAN_DB:
                 mess_to_lower = message_text.lower()
                 match mess_to_lower:
                     case "yes":
-                        await UserManager.delete_all()
-                        response = "Database data burned. DB structure is still saved."
-                        self.last_cmd = CommandType.NO_OP
+                        self._set_last_cmd(update, CommandType.NO_OP)
+                        await self.jobs.submit("clean_db", update.message, self._burn_db)
+                        return
                     case "no":
                         response = "Operation cancelled. Your database integrity is save."
-                        self.last_cmd = CommandType.NO_OP
+                        self._set_last_cmd(update, CommandType.NO_OP)
                     case _:
                         response = "Answer not accepted. Accepted: (yes/no). Try again!"
 
@@ -224,7 +422,7 @@ class Service:
                             # skips itself and the admins
                             if user.is_self or user.id in self.config.admins:
                                 continue
-                            read_id = await UserManager.create(user.id, user.username)
+                            read_id = await self.users.create(user.id, user.username)
                             if read_id > 0:
                                 users_count += 1
                         response = f'Successfully imported {users_count} users from group {message_text}.'
@@ -233,97 +431,99 @@ class Service:
 
             case CommandType.INVITE:
                 try:
-                    (limit_str, destination, forced) = message_text.split(',')
-                    limit = int(limit_str)
-
-                    if limit > 200:
-                        await update.message.reply_text(f"{limit} is greater then max limit 200.")
-                        return
-
-                    # verifies the violation of  200+ invited in 24h
-                    diff = datetime.now() - self.last_invite
-                    if diff.days >= 1:
-                        self.last_invite = datetime.now()
-                        self.invited_users_24h = 0
-
-                    if self.invited_users_24h == 200:
-                        await update.message.reply_text(f"Daily limit reached. "
-                                                        f"You've to wait until to "
-                                                        f"{self.last_invite + timedelta(days=1)}")
-                        return
-
-                    match await self._search_dialog(destination):
-                        case Dialog() as d:
-                            # forces the API to invite also already invited users
-                            is_forced = forced.lower() == "yes"
-                            forced_message = "forcing" if is_forced else "not forcing"
-                            await context.bot.send_message(chat_id=update.effective_chat.id,
-                                                           text=f'Try inviting {limit_str} users '
-                                                                f'to {destination} ({forced_message})...')
-
-                            channel_peer_entity = await self.scout_client.get_input_entity(d.id)
-                            channel_entity = InputChannel(channel_peer_entity.channel_id,
-                                                          channel_peer_entity.access_hash)
-
-                            # read the users from db and try to add them to `destination` chat
-                            refused: int = 0
-                            total_invited: int = 0
-                            user_read: persistence.User
-                            for user_read in await UserManager.read_all(
-                                    include_invited=is_forced,
-                                    limit=limit):
-
-                                # check if 48 hours are passed since the last invite to user_read, if not skip
-                                if (invited_datetime := user_read.invited_at) is not None:
-                                    if (datetime.now() - invited_datetime).days < 2:
-                                        continue
-
-                                try:
-                                    user_peer_entity = await (self.scout_client
-                                                              .get_input_entity(user_read.telegram_id))
-                                    user_entity = InputUser(user_peer_entity.user_id, user_peer_entity.access_hash)
-
-                                    # if self.bot_client is None:
-                                    #     raise ValueError("Bot client not initialized")
-                                    await self.scout_client(InviteToChannelRequest(channel_entity, [user_entity]))
-                                    await UserManager.update_to_invited(user_read.telegram_id)
-                                except UserPrivacyRestrictedError as err:
-                                    # is useless to keep data of a user who locks coming connections
-                                    await UserManager.delete()
-                                    logging.error(f"user_id:{user_read.telegram_id} -> {err}")
-                                    refused += 1
-                                except telethon.errors.rpcerrorlist.UserNotMutualContactError as err:
-                                    # you're locked for 24/48h after the first unilateral contact (User.invited_at)
-                                    logging.error(f"user_id:{user_read.telegram_id} -> {err}")
-                                    refused += 1
-                                except ValueError as verr:
-                                    await update.message.reply_text(f"{verr}")
-                                    return
+                    # one invite at a time: the admins share the scout account and its daily limit
+                    async with self._invite_lock:
+                        (limit_str, destination, forced) = message_text.split(',')
+                        limit = int(limit_str)
+
+                        if limit > self.invites.limit:
+                            await update.message.reply_text(f"{limit} is greater then max limit "
+                                                            f"{self.invites.limit}.")
+                            return
+
+                        # verifies the violation of 200+ invited in the last 24h
+                        if await self.invites.remaining() == 0:
+                            await update.message.reply_text(f"Daily limit reached. "
+                                                            f"You've to wait until to "
+                                                            f"{await self.invites.next_slot()}")
+                            return
+
+                        match await self._search_dialog(destination):
+                            case Dialog() as d:
+                                # forces the API to invite also already invited users
+                                is_forced = forced.lower() == "yes"
+                                forced_message = "forcing" if is_forced else "not forcing"
+                                await context.bot.send_message(chat_id=update.effective_chat.id,
+                                                               text=f'Try inviting {limit_str} users '
+                                                                    f'to {destination} ({forced_message})...')
+
+                                channel_peer_entity = await self.scout_client.get_input_entity(d.id)
+                                channel_entity = InputChannel(channel_peer_entity.channel_id,
+                                                              channel_peer_entity.access_hash)
+
+                                # read the users from db and try to add them to `destination` chat
+                                refused: int = 0
+                                total_invited: int = 0
+                                user_read: persistence.User
+                                async for user_read in self.users.read_all(
+                                        include_invited=is_forced,
+                                        limit=limit):
+
+                                    # check if 48 hours are passed since the last invite to user_read, if not skip
+                                    if (invited_datetime := user_read.invited_at) is not None:
+                                        if (datetime.now() - invited_datetime).days < 2:
+                                            continue
+
+                                    try:
+                                        user_peer_entity = await (self.scout_client
+                                                                  .get_input_entity(user_read.telegram_id))
+                                        user_entity = InputUser(user_peer_entity.user_id, user_peer_entity.access_hash)
+
+                                        # if self.bot_client is None:
+                                        #     raise ValueError("Bot client not initialized")
+                                        await self.scout_client(InviteToChannelRequest(channel_entity, [user_entity]))
+                                        await self.users.update_to_invited(user_read.telegram_id)
+                                    except UserPrivacyRestrictedError as err:
+                                        # is useless to keep data of a user who locks coming connections
+                                        await self.users.delete(user_read.telegram_id)
+                                        logging.error("user_id:%d -> %s", user_read.telegram_id, err,
+                                                      extra={"user_id": user_read.telegram_id})
+                                        refused += 1
+                                    except telethon.errors.rpcerrorlist.UserNotMutualContactError as err:
+                                        # you're locked for 24/48h after the first unilateral contact (User.invited_at)
+                                        logging.error("user_id:%d -> %s", user_read.telegram_id, err,
+                                                      extra={"user_id": user_read.telegram_id})
+                                        refused += 1
+                                    except ValueError as verr:
+                                        await update.message.reply_text(f"{verr}")
+                                        return
+                                    else:
+                                        total_invited += 1
+                                        await self.invites.record(user_read.telegram_id)
+                                        if await self.invites.remaining() == 0:
+                                            break
+
+                                real_inv = f"{limit} users not available, only {total_invited}." \
+                                    if total_invited < limit else ""
+                                if await self.invites.remaining() == 0:
+                                    response = (f'Successfully invited {total_invited - refused}/{total_invited} '
+                                                f'users to {destination}, daily limit reached. '
+                                                f'Next invite allowed at {await self.invites.next_slot()}')
                                 else:
-                                    total_invited += 1
-                                    self.invited_users_24h += 1
-                                    if self.invited_users_24h == 200:
-                                        break
-
-                            real_inv = f"{limit} users not available, only {total_invited}." \
-                                if total_invited < limit else ""
-                            if self.invited_users_24h == 200:
-                                response = ""
-                            else:
-                                response = (f'{real_inv} Successfully invited '
-                                            f'{total_invited - refused}/{total_invited} '
-                                            f'users to {destination}. (restriction due to limit 200 users reached)')
-                        case None:
-                            response = f'Group {destination} not found in chats. Try again!'
+                                    response = (f'{real_inv} Successfully invited '
+                                                f'{total_invited - refused}/{total_invited} '
+                                                f'users to {destination}. (restriction due to limit 200 users reached)')
+                            case None:
+                                response = f'Group {destination} not found in chats. Try again!'
                 except PeerFloodError as err:
-                    logging.error(f"{err}")
+                    logging.error("%s", err)
                     response = ("Flood error, too many attempts."
                                 "Try /disconnect or, if not works, /sign_out after 60 seconds or more.")
                 except ValueError as verr:
                     response = f'{verr}.\nRight format(3 elements): limitNum, destination, forced. Try again!'
 
             case CommandType.NO_OP:
-                response = f"Cannot accept text messages for command {self.last_cmd.name}."
+                response = f"Cannot accept text messages for command {last_cmd.name}."
 
             case CommandType.POST:
                 pass
@@ -332,7 +532,7 @@ class Service:
                 result = await self.scout_client.sign_in(self.config.phone, message_text)
                 if type(result) is telethon.types.User:
                     response = f"User signed in correctly."
-                    self.last_cmd = CommandType.NO_OP
+                    self._set_last_cmd(update, CommandType.NO_OP)
                 else:
                     response = f'\nWrong auth code format. Try again!'
 
@@ -340,63 +540,103 @@ class Service:
                 mess_to_lower = message_text.lower()
                 match mess_to_lower:
                     case "yes":
+                        self.dialogs.invalidate()
                         response = ("Client successfully logged out. "
                                     "To use again the APIs please use /send_code and then /signin") \
                             if await self.scout_client.log_out() \
                             else "INTERNAL SERVER ERROR: could not log out correctly!"
-                        self.last_cmd = CommandType.NO_OP
+                        self._set_last_cmd(update, CommandType.NO_OP)
                     case "no":
                         response = "Operation cancelled. You're still authorized."
-                        self.last_cmd = CommandType.NO_OP
+                        self._set_last_cmd(update, CommandType.NO_OP)
                     case _:
                         response = "Answer not accepted. Accepted: (yes/no). . Try again!"
 
             case CommandType.STAT:
                 dt: datetime = datetime.now()
                 try:
-                    if message_text != "today":
+                    (date_str, *format_str) = [part.strip().lower() for part in message_text.split(',')]
+                    if date_str != "today":
                         from dateutil import parser
-                        dt = parser.parse(message_text)
+                        dt = parser.parse(date_str, dayfirst=True)
                         if dt > datetime.now():
                             raise ValueError()
-
-                    import aiofiles
-                    path: str = f"./stat_{datetime.now()}.txt"
-                    async with aiofiles.open(path, mode="w") as file:
-                        await file.write(f"Statistics until {dt}:\n\n")
-                        await file.write("id | username | created_at | invited_at\n\n")
-                        user_info: persistence.User
-                        for user_info in await UserManager.read_all(until_to=dt):
-                            await file.write(f"{user_info.telegram_id} | {user_info.username} | "
-                                             f"{user_info.created_at} | {user_info.invited_at}\n")
-
-                    message_to_bot_admin = await update.message.reply_document(path)
-                    if message_to_bot_admin is not None:
-                        os.remove(path)
-                        response = f"Download stat file complete."
-                        self.last_cmd = CommandType.NO_OP
-                    else:
-                        response = "Error while downloading the stat file. Try again!"
+                    (fmt, _, compression) = (format_str[0] if format_str else "csv.gz").partition(".")
+                    if len(format_str) > 1 or compression not in ("", "gz"):
+                        raise ValueError(f"Unknown export format {format_str}")
+                    export_format = ExportFormat(fmt)
                 except (OverflowError, ValueError) as err:
                     response = f'{err}\nWrong date string format or limit. Try again!'
-                except FileNotFoundError as err:
-                    response = f"{err}"
+                else:
+                    self._set_last_cmd(update, CommandType.NO_OP)
+                    await self.jobs.submit("stat", update.message,
+                                           lambda job: self._export_stat(update, dt, export_format,
+                                                                         compression == "gz", job))
+                    return
 
             case CommandType.TOKEN_INIT:
                 try:
                     self.bot_client = (TelegramClient('bot_user', self.config.api_id, self.config.api_hash)
                                        .start(bot_token=message_text))
                     response = "Bot user connected."
-                    self.last_cmd = CommandType.NO_OP
+                    self._set_last_cmd(update, CommandType.NO_OP)
                 except ValueError as error:
-                    logging.error(error)
+                    logging.error("%s", error)
                     response = f"{error}. Try again!"
 
         await update.message.reply_text(response)
 
     async def _token(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+        self._set_last_cmd(update, CommandType.TOKEN_INIT)
         await update.message.reply_text("Please, write the bot token")
-        self.last_cmd = CommandType.TOKEN_INIT
+
+    async def _burn_db(self, _: Job) -> str:
+        """Job. Deletes all the users"""
+
+        await self.users.delete_all()
+        return "Database data burned. DB structure is still saved."
+
+    async def _export_stat(self,
+                           update: Update,
+                           until_to: datetime,
+                           export_format: ExportFormat,
+                           compress: bool,
+                           job: Job) -> str:
+        """Job. Exports the users created until `until_to` and sends the file to the admin"""
+
+        export = await export_users(self.users, until_to, fmt=export_format, compress=compress,
+                                    on_progress=lambda rows: job.report(f"{rows} users exported"))
+        with export.file:
+            job.report(f"sending {export.rows} users")
+            if await update.message.reply_document(export.file, filename=export.filename) is None:
+                return "Error while downloading the stat file. Try again!"
+        return f"Download stat file complete ({export.rows} users)."
+
+    @staticmethod
+    async def _remove_stat_files(_: Job) -> str:
+        """Job. Deletes the stat files left in the working directory"""
+
+        def remove() -> int:
+            import fnmatch
+            removed = 0
+            with os.scandir("./") as scan_iter:
+                for file in scan_iter:
+                    if file.is_file() and fnmatch.fnmatch(file.name, "stat_*.txt"):
+                        os.remove("./" + file.name)
+                        removed += 1
+            return removed
+
+        return f"{await asyncio.to_thread(remove)} stats files deleted, chats cache cleared."
+
+    def _format_summary(self, summary: persistence.StatSummary, invites_left: int, next_invite: datetime) -> str:
+        daily_fmt = "\n".join(f"{stat.day}: {stat.created} added, {stat.invited} invited"
+                               for stat in summary.daily)
+        next_invite_fmt = f", next one at {next_invite:%Y-%m-%d %H:%M}" if invites_left == 0 else ""
+        return (f'Users: {summary.created}, invited: {summary.invited}\n'
+                f'Invites left in the last {self.invites.window.total_seconds() / 3600:g}h: '
+                f'{invites_left}/{self.invites.limit}'
+                f'{next_invite_fmt}\n\n'
+                f'Last {len(summary.daily)} active days (UTC):\n{daily_fmt}')
 
     async def _check_conn(self) -> str | None:
         """Returns `str` if the connection fails, else `None`"""
@@ -417,11 +657,7 @@ class Service:
             return res
         return None
 
-    async def _search_dialog(self, message_text: str) -> Dialog | None:
-        """Returns `int` (chat_id) if the user's chats name is `message_str` """
+    async def _search_dialog(self, message_text: str) -> "Dialog | None":
+        """Returns the user's chat named (or with id) `message_text`, if any"""
 
-        dialog: Dialog
-        async for dialog in self.scout_client.iter_dialogs():
-            if dialog.name == message_text:
-                return dialog
-        return None
+        return await self.dialogs.find(message_text)
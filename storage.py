@@ -0,0 +1,405 @@
+"""Storage engines behind `UserManager` and `InviteLedger`, chosen by configuration"""
+
+import asyncio
+import bisect
+import sqlite3
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import replace
+from datetime import date, datetime, timezone
+from functools import wraps
+
+from aiosqlite import connect, Connection, Row
+
+from persistence import DailyStat, StatSummary, Storage, User
+
+STORAGE_ENGINES: tuple[str, ...] = ("sqlite", "memory")
+
+
+def create_storage(engine: str, db_url: str = "market_bot.db", pool_size: int = 4) -> Storage:
+    match engine:
+        case "sqlite":
+            return SqliteStorage(db_url, pool_size)
+        case "memory":
+            return MemoryStorage()
+        case _:
+            raise ValueError(f"Unknown storage engine {engine!r}, expected one of {', '.join(STORAGE_ENGINES)}")
+
+
+def _adapt_datetime(value: datetime) -> int:
+    """Stores `datetime` parameters as integer epoch seconds"""
+    return int(value.timestamp())
+
+
+def _convert_epoch(value: bytes) -> datetime:
+    """Reads columns declared as `epoch` back as local `datetime`"""
+    return datetime.fromtimestamp(int(value))
+
+
+def _register_epoch_types() -> None:
+    """Process-wide `sqlite3` registration, done by the first pool opened so the memory engine leaves it untouched"""
+
+    sqlite3.register_adapter(datetime, _adapt_datetime)
+    sqlite3.register_converter("epoch", _convert_epoch)
+
+
+class ConnectionPool:
+    """
+    Fixed size pool of long-lived `aiosqlite` connections.
+    Connections are opened once by `open` and reused by every query,
+    so the connect (and worker thread spawn) cost is paid only at startup.
+    """
+
+    PRAGMAS: tuple[str, ...] = (
+        "pragma journal_mode = wal",
+        "pragma synchronous = normal",
+        "pragma cache_size = -16000",  # KiB, ~16MB per connection
+        "pragma mmap_size = 268435456",  # 256MB
+        "pragma temp_store = memory",
+        "pragma busy_timeout = 5000",
+    )
+
+    def __init__(self, db_url: str, size: int = 4):
+        if size < 1:
+            raise ValueError(f"Pool size must be at least 1, got {size}")
+        self.db_url = db_url
+        self.size = size
+        self._connections: list[Connection] = []
+        self._idle: asyncio.Queue[Connection] = asyncio.Queue()
+
+    @property
+    def is_open(self) -> bool:
+        return len(self._connections) > 0
+
+    async def open(self) -> None:
+        if self.is_open:
+            return
+        _register_epoch_types()
+        for _ in range(self.size):
+            db = await connect(self.db_url, detect_types=sqlite3.PARSE_DECLTYPES)
+            db.row_factory = Row
+            for pragma in self.PRAGMAS:
+                await db.execute(pragma)
+            self._connections.append(db)
+            self._idle.put_nowait(db)
+
+    async def close(self) -> None:
+        connections, self._connections = self._connections, []
+        self._idle = asyncio.Queue()
+        for db in connections:
+            await db.close()
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Connection]:
+        """Borrows a connection from the pool, waiting if all of them are busy"""
+
+        if not self.is_open:
+            raise RuntimeError("Connection pool not opened")
+        db = await self._idle.get()
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                await db.rollback()
+            self._idle.put_nowait(db)
+
+
+def connect_db(func):
+    """
+    solid — Dependency Inversion
+    Top level modules should not depend
+    on lower level modules,
+    so on the connection is borrowed from the pool
+    the engine has been built with.
+    """
+
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        async with self.pool.acquire() as db:
+            return await func(self, db, *args, **kwargs)
+
+    return wrapper
+
+
+def _epoch_day(value: datetime) -> int:
+    """UTC epoch day, the `user_daily_stat.day` key"""
+    return int(value.timestamp()) // 86400
+
+
+def _utc_date(day: int) -> date:
+    return datetime.fromtimestamp(day * 86400, timezone.utc).date()
+
+
+class SqliteStorage(Storage):
+    """SQLite database, shared through a `ConnectionPool` and migrated when opened"""
+
+    def __init__(self, db_url: str = "market_bot.db", pool_size: int = 4):
+        self.pool = ConnectionPool(db_url, pool_size)
+        self.version: int = 0
+
+    async def open(self) -> None:
+        # imported here, migrations depends on this module for `ConnectionPool`
+        from migrations import enable_incremental_vacuum, migrate
+
+        await self.pool.open()
+        self.version = await migrate(self.pool)
+        await enable_incremental_vacuum(self.pool)
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+    def describe(self) -> str:
+        return f"SQLite {self.pool.db_url} ({self.pool.size} connections, schema version {self.version})"
+
+    @connect_db
+    async def insert_user(self, db: Connection, telegram_id: int, username: str) -> bool:
+        async with db.execute("insert into user(telegram_id, username) values (?, ?) "
+                              "on conflict(telegram_id) do nothing",
+                              (telegram_id, username)) as cursor:
+            inserted = cursor.rowcount
+        await db.commit()
+        return inserted > 0
+
+    @connect_db
+    async def insert_users(self, db: Connection, users: list[User]) -> None:
+        await db.executemany("insert into user(telegram_id, username, created_at, invited_at) values (?, ?, ?, ?)",
+                             ((user.telegram_id, user.username, user.created_at, user.invited_at) for user in users))
+        await db.commit()
+
+    @connect_db
+    async def has_user(self, db: Connection, telegram_id: int) -> bool:
+        async with db.execute("select 1 from user where telegram_id = ?", (telegram_id,)) as cursor:
+            return await cursor.fetchone() is not None
+
+    @staticmethod
+    def _page_query_builder(include_invited: bool, only_ids: bool) -> str:
+        """Util. Builder for the users page queries, keyset on `telegram_id`"""
+
+        where_inv_only = "and invited_at is null" if not include_invited else ""
+        what_select = "telegram_id" if only_ids else "*"
+        query = (f'select {what_select} from user where telegram_id > ? and user.created_at <= ? {where_inv_only} '
+                 f'order by telegram_id limit ?')
+        return query
+
+    @connect_db
+    async def users_page(self,
+                         db: Connection,
+                         after_id: int,
+                         until_to: datetime,
+                         include_invited: bool,
+                         size: int) -> list[User]:
+        rows = await db.execute_fetchall(SqliteStorage._page_query_builder(include_invited, only_ids=False),
+                                         (after_id, until_to, size))
+        return [User(row['telegram_id'], row['username'], row['created_at'], row['invited_at']) for row in rows]
+
+    @connect_db
+    async def user_ids_page(self,
+                            db: Connection,
+                            after_id: int,
+                            until_to: datetime,
+                            include_invited: bool,
+                            size: int) -> list[int]:
+        rows = await db.execute_fetchall(SqliteStorage._page_query_builder(include_invited, only_ids=True),
+                                         (after_id, until_to, size))
+        return [row['telegram_id'] for row in rows]
+
+    @connect_db
+    async def summary(self, db: Connection, days: int) -> StatSummary:
+        """Read from the summary tables maintained by triggers"""
+
+        async with db.execute("select created, invited from user_total_stat") as cursor:
+            totals = await cursor.fetchone()
+        rows = await db.execute_fetchall("select day, created, invited from user_daily_stat "
+                                         "where created > 0 or invited > 0 order by day desc limit ?", (days,))
+        daily = [DailyStat(_utc_date(row['day']), row['created'], row['invited']) for row in rows]
+        return StatSummary(totals['created'], totals['invited'], daily)
+
+    @connect_db
+    async def users_created_before(self, db: Connection, before: datetime, limit: int) -> list[User]:
+        rows = await db.execute_fetchall("select * from user where created_at < ? order by created_at limit ?",
+                                         (before, limit))
+        return [User(row['telegram_id'], row['username'], row['created_at'], row['invited_at']) for row in rows]
+
+    @connect_db
+    async def set_invited(self, db: Connection, telegram_id: int, invited_at: datetime) -> None:
+        await db.execute("update user set invited_at = ? where telegram_id = ?", (invited_at, telegram_id))
+        await db.commit()
+
+    @connect_db
+    async def delete_user(self, db: Connection, telegram_id: int) -> None:
+        await db.execute("delete from user where telegram_id = ?", (telegram_id,))
+        await db.commit()
+
+    @connect_db
+    async def delete_users(self, db: Connection, telegram_ids: list[int]) -> None:
+        """In a single transaction"""
+
+        await db.executemany("delete from user where telegram_id = ?", ((telegram_id,) for telegram_id in telegram_ids))
+        await db.commit()
+
+    @connect_db
+    async def delete_all_users(self, db: Connection) -> None:
+        await db.execute("delete from user")
+        await db.commit()
+
+    @connect_db
+    async def compact(self, db: Connection, pages: int) -> int:
+        """
+        Returns up to `pages` free pages to the file system (requires `auto_vacuum = incremental`).
+        Returns the free pages left.
+        """
+
+        # the pragma frees one page per step and returns no rows, so `execute` would run a single step:
+        # `executescript` steps it to completion
+        await db.executescript(f"pragma incremental_vacuum({int(pages)})")
+        async with db.execute("pragma freelist_count") as cursor:
+            return (await cursor.fetchone())[0]
+
+    @connect_db
+    async def invite_times_after(self, db: Connection, start: datetime) -> list[datetime]:
+        rows = await db.execute_fetchall("select invited_at from invite_event where invited_at > ? "
+                                         "order by invited_at", (start,))
+        return [row['invited_at'] for row in rows]
+
+    @connect_db
+    async def insert_invite(self, db: Connection, telegram_id: int, invited_at: datetime, prune_before: datetime) -> None:
+        await db.execute("insert into invite_event(invited_at, telegram_id) values (?, ?)", (invited_at, telegram_id))
+        await db.execute("delete from invite_event where invited_at < ?", (prune_before,))
+        await db.commit()
+
+
+class MemoryStorage(Storage):
+    """
+    Process memory only, nothing survives a restart: meant for tests and benchmarks.
+    Users are indexed by id in a dict, plus two sorted lists for the range queries:
+    the ids (keyset pages) and the `(created_at, id)` pairs (retention).
+    The daily statistics are kept up to date on each write, like the SQLite triggers.
+    Timestamps are truncated to the second, as SQLite stores them.
+    Stored users are never updated in place, so they are returned without copies.
+    """
+
+    def __init__(self):
+        self._users: dict[int, User] = {}
+        self._ids: list[int] = []
+        self._created: list[tuple[datetime, int]] = []
+        # UTC epoch day -> [created, invited]
+        self._daily: dict[int, list[int]] = {}
+        self._invited: int = 0
+        self._invites: list[datetime] = []
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    def describe(self) -> str:
+        return f"in-memory storage ({len(self._users)} users)"
+
+    def _count(self, value: datetime, column: int, delta: int) -> None:
+        self._daily.setdefault(_epoch_day(value), [0, 0])[column] += delta
+        if column == 1:
+            self._invited += delta
+
+    def _count_user(self, user: User, delta: int) -> None:
+        self._count(user.created_at, 0, delta)
+        if user.invited_at is not None:
+            self._count(user.invited_at, 1, delta)
+
+    def _remove(self, telegram_id: int) -> None:
+        if (user := self._users.pop(telegram_id, None)) is None:
+            return
+        del self._ids[bisect.bisect_left(self._ids, telegram_id)]
+        del self._created[bisect.bisect_left(self._created, (user.created_at, telegram_id))]
+        self._count_user(user, -1)
+
+    async def insert_user(self, telegram_id: int, username: str) -> bool:
+        if telegram_id in self._users:
+            return False
+        user = User(telegram_id, username, datetime.now().replace(microsecond=0), None)
+        self._users[telegram_id] = user
+        bisect.insort(self._ids, telegram_id)
+        bisect.insort(self._created, (user.created_at, telegram_id))
+        self._count_user(user, 1)
+        return True
+
+    async def insert_users(self, users: list[User]) -> None:
+        stored: dict[int, User] = {}
+        for user in users:
+            if user.telegram_id in self._users or user.telegram_id in stored:
+                raise ValueError(f"User {user.telegram_id} already stored")
+            invited_at = user.invited_at.replace(microsecond=0) if user.invited_at is not None else None
+            stored[user.telegram_id] = replace(user, created_at=user.created_at.replace(microsecond=0),
+                                               invited_at=invited_at)
+        for user in stored.values():
+            self._count_user(user, 1)
+        self._users.update(stored)
+        # a single sort of the indexes instead of an insort per user
+        self._ids.extend(stored)
+        self._ids.sort()
+        self._created.extend((user.created_at, user.telegram_id) for user in stored.values())
+        self._created.sort()
+
+    async def has_user(self, telegram_id: int) -> bool:
+        return telegram_id in self._users
+
+    def _page(self, after_id: int, until_to: datetime, include_invited: bool, size: int) -> list[User]:
+        page: list[User] = []
+        for i in range(bisect.bisect_right(self._ids, after_id), len(self._ids)):
+            user = self._users[self._ids[i]]
+            if user.created_at <= until_to and (include_invited or user.invited_at is None):
+                page.append(user)
+                if len(page) == size:
+                    break
+        return page
+
+    async def users_page(self, after_id: int, until_to: datetime, include_invited: bool, size: int) -> list[User]:
+        return self._page(after_id, until_to, include_invited, size)
+
+    async def user_ids_page(self, after_id: int, until_to: datetime, include_invited: bool, size: int) -> list[int]:
+        return [user.telegram_id for user in self._page(after_id, until_to, include_invited, size)]
+
+    async def summary(self, days: int) -> StatSummary:
+        active = sorted((day for day, counts in self._daily.items() if counts[0] > 0 or counts[1] > 0),
+                        reverse=True)[:days]
+        daily = [DailyStat(_utc_date(day), *self._daily[day]) for day in active]
+        return StatSummary(len(self._users), self._invited, daily)
+
+    async def users_created_before(self, before: datetime, limit: int) -> list[User]:
+        end = min(bisect.bisect_left(self._created, (before,)), limit)
+        return [self._users[telegram_id] for _, telegram_id in self._created[:end]]
+
+    async def set_invited(self, telegram_id: int, invited_at: datetime) -> None:
+        if (user := self._users.get(telegram_id)) is None:
+            return
+        if user.invited_at is not None:
+            self._count(user.invited_at, 1, -1)
+        # replaced, not updated in place, as the users already returned must not change
+        self._users[telegram_id] = replace(user, invited_at=invited_at.replace(microsecond=0))
+        self._count(invited_at.replace(microsecond=0), 1, 1)
+
+    async def delete_user(self, telegram_id: int) -> None:
+        self._remove(telegram_id)
+
+    async def delete_users(self, telegram_ids: list[int]) -> None:
+        for telegram_id in telegram_ids:
+            self._remove(telegram_id)
+
+    async def delete_all_users(self) -> None:
+        self._users.clear()
+        self._ids.clear()
+        self._created.clear()
+        self._daily.clear()
+        self._invited = 0
+
+    async def compact(self, pages: int) -> int:
+        """Nothing to release"""
+        return 0
+
+    async def invite_times_after(self, start: datetime) -> list[datetime]:
+        return self._invites[bisect.bisect_right(self._invites, start):]
+
+    async def insert_invite(self, telegram_id: int, invited_at: datetime, prune_before: datetime) -> None:
+        # only the times are queried, the invited user is not kept
+        bisect.insort(self._invites, invited_at)
+        del self._invites[:bisect.bisect_left(self._invites, prune_before)]
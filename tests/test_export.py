@@ -0,0 +1,55 @@
+"""Users export on the in-memory engine"""
+
+import csv
+import gzip
+import io
+import unittest
+from datetime import datetime, timedelta
+
+from export import CSV_HEADER, ExportFormat, export_users
+from persistence import User, UserManager
+from storage import MemoryStorage
+
+NOW = datetime.now().replace(microsecond=0)
+
+
+class ExportTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.storage = MemoryStorage()
+        await self.storage.open()
+        # 3000 users, every other one invited
+        await self.storage.insert_users([User(i, f"user{i}", NOW - timedelta(hours=2),
+                                              NOW - timedelta(hours=1) if i % 2 == 0 else None)
+                                         for i in range(1, 3001)])
+        self.users = UserManager(self.storage)
+
+    async def asyncTearDown(self) -> None:
+        await self.storage.close()
+
+    async def test_csv_includes_invited_users(self) -> None:
+        progress: list[int] = []
+        export = await export_users(self.users, NOW, batch_size=1000, on_progress=progress.append)
+        with export.file:
+            rows = list(csv.reader(io.StringIO(gzip.decompress(export.file.read()).decode())))
+
+        self.assertEqual(export.rows, 3000)
+        self.assertEqual(progress, [1000, 2000, 3000])
+        self.assertEqual(tuple(rows[0]), CSV_HEADER)
+        self.assertEqual(len(rows) - 1, 3000)
+        self.assertEqual(sum(1 for row in rows[1:] if row[3] != ""), 1500)
+        self.assertTrue(export.filename.endswith(".csv.gz"))
+
+    async def test_txt_until_to(self) -> None:
+        await self.users.create(5000, "new")
+        export = await export_users(self.users, NOW - timedelta(minutes=30), fmt=ExportFormat.TXT, compress=False)
+        with export.file:
+            lines = export.file.read().decode().splitlines()
+
+        # the user created after `until_to` is left out
+        self.assertEqual(export.rows, 3000)
+        self.assertEqual(sum(1 for line in lines if line[:1].isdigit()), 3000)
+        self.assertTrue(export.filename.endswith(".txt"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+"""
+Storage engines parity: the same `UserManager` and `InviteLedger` flows run against
+`SqliteStorage` and `MemoryStorage` must give the same results.
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+import asyncio
+import calendar
+import sqlite3
+import tempfile
+import unittest
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+from persistence import InviteLedger, Storage, User, UserManager
+from storage import MemoryStorage, SqliteStorage
+
+NOW = datetime.now().replace(microsecond=0)
+
+
+def dataset() -> list[User]:
+    """60 users over the last 60 days, ids 10, 20, ..., one in three invited a day after creation"""
+
+    return [User(i * 10, f"user{i}", NOW - timedelta(days=60 - i, hours=1),
+                 NOW - timedelta(days=59 - i, hours=1) if i % 3 == 0 else None)
+            for i in range(60)]
+
+
+async def scenario(storage: Storage) -> dict:
+    """Every manager call of the service, the observed results by step"""
+
+    users = UserManager(storage, cache_size=100)
+    steps: dict = {}
+    await storage.insert_users(dataset())
+
+    steps["create"] = (await users.create(1, "new"), await users.create(1, "new"), await users.create(10, "dup"))
+    steps["find"] = (await users.find(1), await users.find(20), await users.find(25), await users.find(25))
+    steps["cache"] = (users.cache.hits, users.cache.misses)
+
+    await users.update_to_invited(20)
+    await users.delete(30)
+    await users.delete_many([40, 50])
+    steps["find_after_writes"] = (await users.find(30), await users.find(40), await users.find(20))
+
+    steps["read_all"] = [(user.telegram_id, user.username, user.created_at, user.invited_at)
+                         async for user in users.read_all(page_size=7)]
+    steps["read_all_invited"] = [user.telegram_id
+                                 async for user in users.read_all(include_invited=True, limit=25, page_size=4)]
+    steps["read_all_ids"] = [telegram_id async for telegram_id in users.read_all_ids(
+        until_to=NOW - timedelta(days=30), include_invited=True, page_size=6)]
+
+    summary = await users.summary(days=10)
+    steps["summary"] = (summary.created, summary.invited, [(day.day, day.created, day.invited)
+                                                           for day in summary.daily])
+
+    old = await users.read_created_before(NOW - timedelta(days=45), 5)
+    steps["read_created_before"] = [user.telegram_id for user in old]
+    await users.delete_many([user.telegram_id for user in old])
+    steps["after_retention"] = [user.telegram_id for user in await users.read_created_before(NOW, 3)]
+
+    invites = InviteLedger(storage, limit=3, window=timedelta(hours=1))
+    for telegram_id in (60, 70, 80):
+        await invites.record(telegram_id)
+    steps["ledger"] = (await invites.used(), await invites.remaining())
+    steps["ledger_reloaded"] = await InviteLedger(storage, limit=3, window=timedelta(hours=1)).used()
+
+    await users.delete_all()
+    summary = await users.summary()
+    steps["delete_all"] = (summary.created, summary.invited, summary.daily, await users.find(1))
+    steps["compact"] = await users.compact(100) >= 0
+    return steps
+
+
+class StorageParityTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.db_url = str(Path(self._tmp_dir.name) / "test.db")
+
+    async def asyncTearDown(self) -> None:
+        self._tmp_dir.cleanup()
+
+    async def _run(self, storage: Storage) -> dict:
+        await storage.open()
+        try:
+            return await scenario(storage)
+        finally:
+            await storage.close()
+
+    async def test_memory_scenario(self) -> None:
+        steps = await self._run(MemoryStorage())
+
+        self.assertEqual(steps["create"], (1, 0, 0))
+        self.assertEqual(steps["find"], (1, 20, 0, 0))
+        # create cached 1, the second lookup of 25 is a cached miss
+        self.assertEqual(steps["cache"], (3, 4))
+        self.assertEqual(steps["find_after_writes"], (0, 0, 20))
+        self.assertNotIn(30, [row[0] for row in steps["read_all"]])
+        self.assertTrue(all(row[3] is None for row in steps["read_all"]))
+        self.assertEqual(len(steps["read_all_invited"]), 25)
+        self.assertEqual(steps["read_all_ids"], [i * 10 for i in range(31) if i not in (3, 4, 5)])
+        self.assertEqual(steps["summary"][:2], (58, 20))
+        self.assertEqual(steps["read_created_before"], [0, 10, 20, 60, 70])
+        self.assertEqual(steps["after_retention"], [80, 90, 100])
+        self.assertEqual(steps["ledger"], (3, 0))
+        self.assertEqual(steps["ledger_reloaded"], 3)
+        self.assertEqual(steps["delete_all"], (0, 0, [], 0))
+
+    async def test_sqlite_matches_memory(self) -> None:
+        expected = await self._run(MemoryStorage())
+        actual = await self._run(SqliteStorage(self.db_url, pool_size=2))
+
+        for step, value in expected.items():
+            with self.subTest(step=step):
+                self.assertEqual(actual[step], value)
+
+
+class _SlowLoadStorage(MemoryStorage):
+    """Suspends while loading the invites, as a database query does"""
+
+    async def invite_times_after(self, start: datetime) -> list[datetime]:
+        times = await super().invite_times_after(start)
+        await asyncio.sleep(0.01)
+        return times
+
+
+class InviteLedgerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_first_load(self) -> None:
+        storage = _SlowLoadStorage()
+        for telegram_id in (1, 2):
+            await storage.insert_invite(telegram_id, datetime.now(), NOW - timedelta(days=30))
+
+        # e.g. `/stat summary` while an invite is recorded, right after a restart:
+        # the summary load starts before the invite is stored and ends after it
+        invites = InviteLedger(storage, limit=5)
+        await asyncio.gather(invites.record(3), invites.remaining())
+
+        self.assertEqual(await invites.used(), 3)
+        self.assertEqual(await InviteLedger(storage, limit=5).used(), 3)
+
+
+class SqliteMigrationTest(unittest.IsolatedAsyncioTestCase):
+    async def test_migrates_baseline_schema(self) -> None:
+        """Databases created before the migrations: `current_timestamp` strings, `user_version` 0"""
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_url = str(Path(tmp_dir) / "baseline.db")
+            db = sqlite3.connect(db_url)
+            db.execute("""create table if not exists user (
+telegram_id integer,
+username text not null,
+created_at timestamp default current_timestamp,
+invited_at timestamp,
+primary key(telegram_id))""")
+            db.execute("insert into user(telegram_id, username) values (1, 'today')")
+            db.execute("insert into user(telegram_id, username, created_at, invited_at) "
+                       "values (2, 'old', '2024-01-02 03:04:05', '2024-01-03 10:00:00')")
+            db.commit()
+            db.close()
+
+            storage = SqliteStorage(db_url, pool_size=1)
+            await storage.open()
+            try:
+                users = UserManager(storage)
+                self.assertEqual(storage.version, 5)
+                stored = {user.telegram_id: user async for user in users.read_all(include_invited=True)}
+                summary = await users.summary()
+            finally:
+                await storage.close()
+
+        # `current_timestamp` is UTC, read back as local time
+        utc = datetime(2024, 1, 2, 3, 4, 5)
+        self.assertEqual(stored[2].created_at, datetime.fromtimestamp(calendar.timegm(utc.timetuple())))
+        self.assertEqual(stored[2].invited_at, datetime.fromtimestamp(calendar.timegm((2024, 1, 3, 10, 0, 0))))
+        self.assertLess(abs(stored[1].created_at - datetime.now()), timedelta(minutes=1))
+        self.assertIsNone(stored[1].invited_at)
+
+        self.assertEqual((summary.created, summary.invited), (2, 1))
+        daily = {day.day: (day.created, day.invited) for day in summary.daily}
+        self.assertEqual(daily[date(2024, 1, 2)], (1, 0))
+        self.assertEqual(daily[date(2024, 1, 3)], (0, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()